@@ -6,78 +6,2618 @@ FutureChat Web Advanced - Продвинутая веб-версия AI Чат-
 Объединяет машинное обучение ChatterBot с удобным веб-интерфейсом
 """
 
-from flask import Flask, render_template_string, request, jsonify
-from chatterbot import ChatBot
-from chatterbot.trainers import ChatterBotCorpusTrainer, ListTrainer
+import time
+PROCESS_STARTED = time.perf_counter()
+
+from flask import Flask, Response, render_template_string, request, jsonify, stream_with_context
+import ast
+import hashlib
+import importlib.util
+import heapq
 import json
+import math
+import mmap
+import operator
 import os
+import pickle
 import random
+import resource
 import re
-from datetime import datetime
-import nltk
-try:
-    from sklearn.feature_extraction.text import TfidfVectorizer
-    from sklearn.metrics.pairwise import cosine_similarity
-    import numpy as np
-    SKLEARN_AVAILABLE = True
-except ImportError:
-    SKLEARN_AVAILABLE = False
-    print("⚠️ Sklearn не найден, используется упрощенная NLP")
+import secrets
+import sys
+import threading
+import asyncio
+import atexit
+import gc
+import signal
+import socket
+import sqlite3
+import struct
+from functools import lru_cache
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from decimal import Decimal, localcontext
+from fractions import Fraction
+
+# Замеры запуска: (вид, имя, секунды) - импорты и фазы инициализации
+STARTUP_TIMINGS = [('import', 'flask и стандартная библиотека', time.perf_counter() - PROCESS_STARTED)]
+
+@contextmanager
+def startup_timer(kind, name):
+    """Замер импорта или фазы инициализации для профиля запуска"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS.append((kind, name, time.perf_counter() - start))
+
+def print_startup_profile():
+    """Разбивка времени запуска по импортам и фазам инициализации"""
+    titles = {'import': 'Импорты', 'phase': 'Фазы инициализации', 'total': 'Итого'}
+    print("⏱️ Профиль запуска:")
+    for kind in ('import', 'phase', 'total'):
+        rows = [(name, seconds) for row_kind, name, seconds in STARTUP_TIMINGS if row_kind == kind]
+        if rows:
+            print(f"   {titles[kind]}:")
+            for name, seconds in rows:
+                print(f"      {name:<36} {seconds * 1000:9.1f} мс")
+
+# Тяжелые модули (sklearn/numpy/scipy - больше секунды, ChatterBot тянет
+# spaCy) импортируются при первом использовании, а не при импорте main
+SKLEARN_AVAILABLE = importlib.util.find_spec('sklearn') is not None
+HashingVectorizer = normalize = murmurhash3_32 = np = sp = None
+
+def import_sklearn():
+    """Ленивый импорт sklearn, numpy и scipy; False - если их нет"""
+    global HashingVectorizer, normalize, murmurhash3_32, np, sp, SKLEARN_AVAILABLE
+    if np is not None or not SKLEARN_AVAILABLE:
+        return SKLEARN_AVAILABLE
+    try:
+        with startup_timer('import', 'sklearn/numpy/scipy'):
+            from sklearn.feature_extraction.text import HashingVectorizer
+            from sklearn.preprocessing import normalize
+            from sklearn.utils import murmurhash3_32
+            import numpy as np
+            import scipy.sparse as sp
+    except ImportError:
+        SKLEARN_AVAILABLE = False
+        print("⚠️ Sklearn не найден, используется упрощенная NLP")
+    return SKLEARN_AVAILABLE
+
+# Данные NLTK ищутся только на диске, без обращений к сети
+NLTK_RESOURCES = ('tokenizers/punkt', 'corpora/stopwords', 'corpora/wordnet')
+
+def nltk_data_paths():
+    """Каталоги поиска данных NLTK (как nltk.data.path, но без импорта nltk)"""
+    paths = [path for path in os.environ.get('NLTK_DATA', '').split(os.pathsep) if path]
+    paths.append(os.path.expanduser('~/nltk_data'))
+    paths += [os.path.join(sys.prefix, suffix) for suffix in ('nltk_data', 'share/nltk_data', 'lib/nltk_data')]
+    paths += ['/usr/share/nltk_data', '/usr/local/share/nltk_data', '/usr/lib/nltk_data', '/usr/local/lib/nltk_data']
+    return paths
+
+def missing_nltk_resources():
+    """Ресурсы NLTK, которых нет ни в одном каталоге (ни папкой, ни zip-архивом)"""
+    paths = nltk_data_paths()
+    return [resource for resource in NLTK_RESOURCES
+            if not any(os.path.exists(os.path.join(path, resource)) or
+                       os.path.exists(os.path.join(path, resource + '.zip')) for path in paths)]
+
+app = Flask(__name__)
+
+CHATBOT_DATABASE_PATH = 'web_advanced_chatbot.sqlite3'
+TRAINING_MANIFEST_PATH = 'web_advanced_chatbot.training.json'
+
+# Режим обслуживания: ChatterBot не пишет в базу на каждом запросе,
+# выученные диалоги копятся в памяти и сбрасываются пакетами
+CHATBOT_READ_ONLY = os.environ.get('FUTURECHAT_READ_ONLY', '1') == '1'
+LEARNING_FLUSH_INTERVAL = float(os.environ.get('FUTURECHAT_LEARNING_FLUSH_INTERVAL', '5'))
+LEARNING_BATCH_SIZE = int(os.environ.get('FUTURECHAT_LEARNING_BATCH_SIZE', '200'))
+
+# Настройка SQLite базы ChatterBot: PRAGMA каждого соединения и индексы
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', os.environ.get('FUTURECHAT_SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ('busy_timeout', int(os.environ.get('FUTURECHAT_SQLITE_BUSY_TIMEOUT_MS', '5000'))),
+    ('mmap_size', int(os.environ.get('FUTURECHAT_SQLITE_MMAP_MB', '256')) * 1024 * 1024),
+    ('cache_size', -int(os.environ.get('FUTURECHAT_SQLITE_CACHE_MB', '64')) * 1024),
+    ('temp_store', 'MEMORY'),
+)
+# in_response_to покрывает выборку пар вопрос-ответ для семантического индекса
+SQLITE_INDEXES = (
+    ('idx_fc_statement_text', 'statement (text)'),
+    ('idx_fc_statement_in_response_to', 'statement (in_response_to, text, persona)'),
+    ('idx_fc_statement_conversation', 'statement (conversation, id)'),
+)
+# Интервал (сек) фонового чекпоинта WAL с усечением файла (0 - выключен)
+SQLITE_CHECKPOINT_INTERVAL = float(os.environ.get('FUTURECHAT_SQLITE_CHECKPOINT_INTERVAL', '60'))
+# Запросы BestMatch и ChatterBot для замеров: (имя, SQL, номера полей записи-образца)
+# Поля образца: text, search_text, conversation, in_response_to, search_in_response_to
+SQLITE_PROBE_QUERIES = (
+    ('best_match', "SELECT id, text FROM statement WHERE search_text = ? AND persona NOT LIKE 'bot:%'", (1,)),
+    ('alternate_responses', "SELECT id, text FROM statement WHERE search_in_response_to = ? AND persona NOT LIKE 'bot:%'", (4,)),
+    ('recent_responses', "SELECT id, text FROM statement WHERE conversation = ? ORDER BY id", (2,)),
+    ('statement_by_text', "SELECT id FROM statement WHERE text = ? AND conversation = ? LIMIT 1", (0, 2)),
+    ('in_response_to', "SELECT id, text FROM statement WHERE in_response_to = ?", (3,)),
+)
+
+# Обслуживание таблицы statement: дубликаты, срок хранения выученного и VACUUM
+MAINTENANCE_INTERVAL = float(os.environ.get('FUTURECHAT_MAINTENANCE_INTERVAL', '86400'))
+RETENTION_DAYS = float(os.environ.get('FUTURECHAT_RETENTION_DAYS', '90'))
+RETENTION_KEEP_OCCURRENCES = int(os.environ.get('FUTURECHAT_RETENTION_KEEP_OCCURRENCES', '3'))
+MAINTENANCE_VACUUM_PAGES = 1000
+MAINTENANCE_PROBES = 200
+
+# Параметры индексированного поиска ChatterBot
+INDEX_SEARCH_TOP_K = 20
+INDEX_SEARCH_MAX_POSTINGS = 1000
+
+# База знаний: снимок JSON и журнал обучения
+KNOWLEDGE_PATH = 'web_advanced_knowledge.json'
+KNOWLEDGE_JOURNAL_PATH = 'web_advanced_knowledge.journal.jsonl'
+KNOWLEDGE_FSYNC_INTERVAL = float(os.environ.get('FUTURECHAT_KNOWLEDGE_FSYNC_INTERVAL', '1'))
+KNOWLEDGE_COMPACT_ENTRIES = 1000
+
+# Прогрев ChatterBot и семантического индекса в фоне (0 - синхронно при запуске)
+BACKGROUND_WARMUP = os.environ.get('FUTURECHAT_BACKGROUND_WARMUP', '1') == '1'
+
+# Печать профиля запуска (импорты и фазы) после инициализации
+STARTUP_PROFILE = os.environ.get('FUTURECHAT_STARTUP_PROFILE', '0') == '1'
+
+# Многопроцессный сервер: число воркеров и отчет о памяти
+SERVER_WORKERS = int(os.environ.get('FUTURECHAT_WORKERS', '1'))
+SERVER_GRACEFUL_TIMEOUT = float(os.environ.get('FUTURECHAT_GRACEFUL_TIMEOUT', '30'))
+SERVER_MEMORY_REPORT_INTERVAL = float(os.environ.get('FUTURECHAT_MEMORY_REPORT_INTERVAL', '0'))
+
+# Асинхронный сервер: пул для стадий конвейера, очередь и keep-alive соединений
+ASYNC_WORKERS = int(os.environ.get('FUTURECHAT_ASYNC_WORKERS', '32'))
+ASYNC_MAX_PENDING = int(os.environ.get('FUTURECHAT_ASYNC_MAX_PENDING', '1024'))
+ASYNC_KEEPALIVE_TIMEOUT = float(os.environ.get('FUTURECHAT_ASYNC_KEEPALIVE_TIMEOUT', '75'))
+ASYNC_MAX_BODY = 1024 * 1024
+
+# Корзины гистограмм задержек для /metrics (секунды)
+METRICS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Пакетный API: максимум сообщений в одном запросе /chat/batch
+BATCH_MAX_MESSAGES = int(os.environ.get('FUTURECHAT_BATCH_MAX_MESSAGES', '1000'))
+
+# Параллельный опрос источников ответов: общий дедлайн и размер пула
+RESPONSE_DEADLINE = float(os.environ.get('FUTURECHAT_RESPONSE_DEADLINE', '1'))
+RESPONSE_WORKERS = int(os.environ.get('FUTURECHAT_RESPONSE_WORKERS', '8'))
+
+# Кэш базовых ответов: размер, TTL и короткий TTL для ответов о времени
+RESPONSE_CACHE_SIZE = int(os.environ.get('FUTURECHAT_RESPONSE_CACHE_SIZE', '2048'))
+RESPONSE_CACHE_TTL = float(os.environ.get('FUTURECHAT_RESPONSE_CACHE_TTL', '300'))
+RESPONSE_CACHE_TIME_TTL = 1.0
+
+# История разговоров по сессиям
+SESSION_COOKIE = 'futurechat_session'
+DEFAULT_SESSION = 'default'
+SESSION_HISTORY_LENGTH = 20
+SESSION_MAX_COUNT = 100000
+SESSION_MEMORY_LIMIT = int(os.environ.get('FUTURECHAT_SESSION_MEMORY_MB', '256')) * 1024 * 1024
+SESSION_IDLE_TIMEOUT = float(os.environ.get('FUTURECHAT_SESSION_IDLE_TIMEOUT', '3600'))
+
+# Лимиты вычислителя арифметики
+MATH_MAX_EXPRESSION_LENGTH = 200
+MATH_MAX_DIGITS = 1000
+MATH_MAX_OPERATIONS = 100
+MATH_TIME_BUDGET = 0.01
+MATH_DECIMAL_PRECISION = 50
+
+# Семантический поиск по TF-IDF: сохраненная матрица и порог уверенности
+SEMANTIC_INDEX_PATH = 'web_advanced_semantic.pkl'
+SEMANTIC_TOP_K = 5
+SEMANTIC_MIN_SCORE = 0.2
+SEMANTIC_HASH_FEATURES = 2 ** 18
+SEMANTIC_STOP_WORDS = [
+    'что', 'такое', 'это', 'как', 'про', 'за', 'расскажи', 'объясни', 'мне', 'ты', 'я',
+    'и', 'в', 'во', 'на', 'о', 'об', 'с', 'со', 'по', 'а', 'но', 'или', 'ли', 'же', 'ну'
+]
+SEMANTIC_COMPACT_THRESHOLD = 1000
+SEMANTIC_COMPACT_INTERVAL = float(os.environ.get('FUTURECHAT_SEMANTIC_COMPACT_INTERVAL', '60'))
+
+# Снимок производного состояния (python main.py build-snapshot); пустое значение - не загружать
+WARM_STATE_PATH = os.environ.get('FUTURECHAT_WARM_STATE', 'web_advanced_warm_state.bin')
+
+
+class TrainingManifest:
+    """Манифест обучения: хэши источников, которые уже загружены в базу ChatterBot"""
+
+    def __init__(self, path=TRAINING_MANIFEST_PATH):
+        self.path = path
+        self.sources = {}
+        self.load()
+
+    @staticmethod
+    def digest(payload):
+        """Хэш содержимого источника обучения"""
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(payload).hexdigest()
+
+    def load(self):
+        """Загрузка манифеста с диска"""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.sources = json.load(f).get('sources', {})
+        except Exception as e:
+            print(f"⚠️ Манифест обучения поврежден, будет пересоздан: {e}")
+            self.sources = {}
+
+    def save(self):
+        """Атомарное сохранение манифеста рядом с базой"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'sources': self.sources}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        """Сброс манифеста (например, если база была удалена)"""
+        self.sources = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def is_current(self, source, digest):
+        return self.sources.get(source, {}).get('digest') == digest
+
+    def mark_trained(self, source, digest):
+        self.sources[source] = {
+            'digest': digest,
+            'trained_at': datetime.now().isoformat()
+        }
+        self.save()
+
+
+class InvertedIndexSearch:
+    """Поиск кандидатов для BestMatch по инвертированному индексу токенов
+
+    Вместо сравнения входа с каждой записью таблицы по Левенштейну индекс
+    отбирает top-K записей с наибольшим IDF-весом общих токенов, и только
+    они проходят точное сравнение. Новые записи догружаются по id > last_id.
+    """
+
+    name = 'inverted_index_search'
+
+    def __init__(self, chatbot, top_k=INDEX_SEARCH_TOP_K, max_postings=INDEX_SEARCH_MAX_POSTINGS):
+        from chatterbot.comparisons import LevenshteinDistance
+
+        self.chatbot = chatbot
+        self.compare_statements = LevenshteinDistance(language=chatbot.tagger.language)
+        self.top_k = top_k
+        self.max_postings = max_postings
+        self.postings = defaultdict(lambda: array('q'))
+        self.documents = 0
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text):
+        return set(re.findall(r'\w+', text.lower())) if text else set()
+
+    def refresh(self):
+        """Добавление в индекс записей, появившихся после последнего обновления"""
+        storage = self.chatbot.storage
+        Statement = storage.get_model('statement')
+
+        with self.lock:
+            session = storage.Session()
+            try:
+                rows = session.query(
+                    Statement.id, Statement.in_response_to, Statement.persona
+                ).filter(Statement.id > self.last_id).order_by(Statement.id).all()
+            finally:
+                session.close()
+
+            for statement_id, in_response_to, persona in rows:
+                self.last_id = statement_id
+                if not in_response_to or persona.startswith('bot:'):
+                    continue
+                for token in self.tokenize(in_response_to):
+                    posting = self.postings[token]
+                    if not isinstance(posting, array):
+                        # Срез из снимка только для чтения - копируем перед дописью
+                        posting = self.postings[token] = array('q', posting)
+                    posting.append(statement_id)
+                self.documents += 1
+
+    def rebuild(self):
+        """Пересборка после удаления записей из базы; поиск работает по старому индексу до подмены"""
+        rebuilt = InvertedIndexSearch(self.chatbot, top_k=self.top_k, max_postings=self.max_postings)
+        rebuilt.refresh()
+        with self.lock:
+            self.postings, self.documents, self.last_id = rebuilt.postings, rebuilt.documents, rebuilt.last_id
+
+    def fingerprint(self, last_id):
+        """Число записей с id <= last_id и текст последней: не меняются, пока записи не удаляют"""
+        from sqlalchemy import func
+
+        storage = self.chatbot.storage
+        Statement = storage.get_model('statement')
+        session = storage.Session()
+        try:
+            rows = session.query(func.count(Statement.id)).filter(Statement.id <= last_id).scalar()
+            text = session.query(Statement.text).filter(Statement.id == last_id).scalar()
+        finally:
+            session.close()
+        return rows, text
+
+    def export_state(self):
+        """Постинги для снимка: список токенов и два плоских массива (границы и id записей)"""
+        with self.lock:
+            tokens = list(self.postings)
+            offsets, ids = array('q', [0]), array('q')
+            for token in tokens:
+                ids.extend(self.postings[token])
+                offsets.append(len(ids))
+            state = {'tokens': tokens, 'documents': self.documents, 'last_id': self.last_id}
+        state['fingerprint'] = self.fingerprint(state['last_id'])
+        return state, offsets, ids
+
+    def restore_state(self, state, offsets, ids):
+        """Постинги из снимка - срезы ids без копирования; False - записи в базе изменились"""
+        if self.fingerprint(state['last_id']) != state['fingerprint']:
+            return False
+        with self.lock:
+            for position, token in enumerate(state['tokens']):
+                self.postings[token] = ids[offsets[position]:offsets[position + 1]]
+            self.documents = state['documents']
+            self.last_id = state['last_id']
+        return True
+
+    def get_candidate_ids(self, text):
+        """Top-K записей по сумме IDF общих токенов"""
+        postings = [self.postings[token] for token in self.tokenize(text) if token in self.postings]
+        postings.sort(key=len)
+
+        scores = defaultdict(float)
+        for posting in postings:
+            idf = math.log(1 + self.documents / len(posting))
+            # Для частых токенов берем только самые свежие записи
+            for statement_id in posting[-self.max_postings:]:
+                scores[statement_id] += idf
+
+        return heapq.nlargest(self.top_k, scores, key=scores.__getitem__)
+
+    def search(self, input_statement, **additional_parameters):
+        """Поиск ближайших записей, совместимый с IndexedTextSearch.search"""
+        self.refresh()
+
+        candidate_ids = self.get_candidate_ids(input_statement.text)
+        if not candidate_ids:
+            return
+
+        storage = self.chatbot.storage
+        Statement = storage.get_model('statement')
+        session = storage.Session()
+        try:
+            candidates = [
+                storage.model_to_object(statement)
+                for statement in session.query(Statement).filter(Statement.id.in_(candidate_ids))
+            ]
+        finally:
+            session.close()
+
+        best_confidence_so_far = 0
+
+        for statement in candidates:
+            confidence = self.compare_statements.compare_text(
+                input_statement.text, statement.in_response_to
+            )
+
+            if confidence > best_confidence_so_far:
+                best_confidence_so_far = confidence
+                statement.confidence = confidence
+
+                yield statement
+
+                if confidence >= 1.0:
+                    break
+
+
+class LearningWriter:
+    """Фоновая запись выученных диалогов в базу ChatterBot пакетными транзакциями
+
+    Запросы только кладут диалоги в очередь в памяти; фоновый поток сбрасывает
+    очередь одной транзакцией раз в flush_interval секунд или как только
+    накопится batch_size записей.
+    """
+
+    def __init__(self, chatbot, flush_interval=LEARNING_FLUSH_INTERVAL, batch_size=LEARNING_BATCH_SIZE):
+        self.chatbot = chatbot
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = deque()
+        self.last_responses = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.stopped = False
+        self.holds = 0
+        self.written = 0
+        self.thread = None
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='learning-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Остановка потока с финальным сбросом очереди"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def last_response(self, conversation):
+        """Последний ответ бота в разговоре (без запроса к базе)"""
+        return self.last_responses.get(conversation)
+
+    def learn(self, input_text, response):
+        """Постановка пары вход-ответ в очередь на запись"""
+        previous = self.last_responses.get(response.conversation)
+        self.last_responses[response.conversation] = response.text
+        self.enqueue(('response', input_text, previous, response))
+
+    def add_conversation(self, texts):
+        """Постановка обучающего диалога в очередь (аналог ListTrainer.train)"""
+        self.enqueue(('training', texts))
+
+    def enqueue(self, item):
+        with self.condition:
+            self.pending.append(item)
+            if len(self.pending) >= self.batch_size and not self.holds:
+                self.condition.notify()
+
+    @contextmanager
+    def hold(self):
+        """Отложить фоновую запись до конца блока и записать все одной транзакцией"""
+        with self.condition:
+            self.holds += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.holds -= 1
+            self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and (len(self.pending) < self.batch_size or self.holds):
+                    self.condition.wait(self.flush_interval)
+                if self.stopped:
+                    return
+                if self.holds:
+                    continue
+            self.flush()
+
+    def build_statements(self, item):
+        """Записи ChatterBot для элемента очереди (как при обычном обучении)"""
+        from chatterbot.conversation import Statement
+
+        index = self.chatbot.tagger.get_text_index_string
+
+        if item[0] == 'training':
+            statements = []
+            previous_text, previous_search_text = None, ''
+            for text in item[1]:
+                search_text = index(text)
+                statements.append(Statement(
+                    text=text,
+                    search_text=search_text,
+                    in_response_to=previous_text,
+                    search_in_response_to=previous_search_text,
+                    conversation='training'
+                ))
+                previous_text, previous_search_text = text, search_text
+            return statements
+
+        _, input_text, previous, response = item
+        input_search_text = index(input_text)
+        input_statement = Statement(
+            text=input_text,
+            search_text=input_search_text,
+            in_response_to=previous,
+            search_in_response_to=index(previous) if previous else '',
+            conversation=response.conversation
+        )
+        response_statement = Statement(
+            text=response.text,
+            search_text=index(response.text),
+            in_response_to=input_text,
+            search_in_response_to=input_search_text,
+            conversation=response.conversation,
+            persona=response.persona or 'bot:' + self.chatbot.name
+        )
+        return [input_statement, response_statement]
+
+    def flush(self):
+        """Запись всей очереди одной транзакцией"""
+        with self.flush_lock:
+            with self.condition:
+                items = list(self.pending)
+                self.pending.clear()
+
+            if not items:
+                return 0
+
+            statements = []
+            for item in items:
+                statements.extend(self.build_statements(item))
+
+            try:
+                self.chatbot.storage.create_many(statements)
+            except Exception as e:
+                print(f"⚠️ Ошибка пакетной записи ChatterBot: {e}")
+                with self.condition:
+                    self.pending.extendleft(reversed(items))
+                return 0
+
+            self.written += len(statements)
+            return len(statements)
+
+
+class SQLiteStorageTuning:
+    """Настройка SQLite под SQLStorageAdapter ChatterBot
+
+    ChatterBot создает движок из голого database_uri, поэтому PRAGMA ставятся
+    обработчиком connect на каждое новое соединение пула, а индексы под
+    запросы по text, in_response_to и conversation создаются при запуске.
+    Автоматический чекпоинт SQLite переносит страницы в базу, но не уменьшает
+    файл -wal, и тот остается размером с самый большой всплеск записи;
+    фоновый поток раз в checkpoint_interval секунд делает wal_checkpoint(TRUNCATE).
+    """
+
+    def __init__(self, engine, pragmas=SQLITE_PRAGMAS, indexes=SQLITE_INDEXES,
+                 checkpoint_interval=SQLITE_CHECKPOINT_INTERVAL):
+        self.engine = engine
+        self.pragmas = pragmas
+        self.indexes = indexes
+        self.checkpoint_interval = checkpoint_interval
+        self.wal_path = f"{engine.url.database}-wal" if engine is not None else None
+        self.checkpoints = defaultdict(int)
+        self.last_checkpoint = None
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def apply_pragmas(self, dbapi_connection, connection_record=None):
+        """PRAGMA для нового соединения (обработчик события connect)"""
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas:
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    def create_indexes(self, dbapi_connection):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, columns in self.indexes:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+            dbapi_connection.commit()
+        finally:
+            cursor.close()
+
+    def install(self):
+        """Подключение PRAGMA к движку и создание индексов"""
+        from sqlalchemy import event
+
+        event.listen(self.engine, 'connect', self.apply_pragmas)
+        # Соединения, открытые ChatterBot до нас, пересоздаются уже с PRAGMA
+        self.engine.dispose()
+        connection = self.engine.raw_connection()
+        try:
+            self.create_indexes(connection)
+        finally:
+            connection.close()
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
+
+    def checkpoint(self, mode='TRUNCATE'):
+        """Чекпоинт WAL: (занято, кадров в журнале, перенесено кадров)"""
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f"PRAGMA wal_checkpoint({mode})")
+            busy, log_frames, checkpointed = cursor.fetchone()
+            cursor.close()
+        finally:
+            connection.close()
+        self.checkpoints['busy' if busy else 'ok'] += 1
+        self.last_checkpoint = time.time()
+        return busy, log_frames, checkpointed
+
+    def start(self):
+        if self.checkpoint_interval <= 0:
+            return
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='sqlite-checkpoint', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Остановка потока с финальным чекпоинтом"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        try:
+            self.checkpoint()
+        except Exception as e:
+            print(f"⚠️ Ошибка чекпоинта WAL: {e}")
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped:
+                    self.condition.wait(self.checkpoint_interval)
+                if self.stopped:
+                    return
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.checkpoints['error'] += 1
+                print(f"⚠️ Ошибка чекпоинта WAL: {e}")
+
+
+class StatementMaintenance:
+    """Обслуживание таблицы statement ChatterBot
+
+    Один проход (run_once) в одной транзакции:
+    - дубликаты: записи с одинаковыми text, in_response_to и persona (повторное
+      обучение, одинаковые диалоги) сворачиваются в самую свежую, число
+      повторов копится в колонке occurrences, теги переносятся на нее;
+    - срок хранения: выученные записи (не из разговора 'training') старше
+      retention_days удаляются, если на них нельзя ответить (нет in_response_to)
+      или они встречались реже keep_occurrences раз;
+    затем освободившиеся страницы возвращаются инкрементальным VACUUM порциями
+    по vacuum_pages, не блокируя запись надолго (перевод базы в этот режим -
+    полным VACUUM - делает только команда maintain). Отчет - число удаленных строк,
+    размер файла и задержки типичных запросов до и после.
+    """
+
+    def __init__(self, engine, retention_days=RETENTION_DAYS, keep_occurrences=RETENTION_KEEP_OCCURRENCES,
+                 interval=MAINTENANCE_INTERVAL, vacuum_pages=MAINTENANCE_VACUUM_PAGES, on_change=None):
+        self.engine = engine
+        self.retention_days = retention_days
+        self.keep_occurrences = keep_occurrences
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.on_change = on_change
+        self.database_path = engine.url.database
+        self.last_report = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def database_size(self):
+        return sum(os.path.getsize(path) for path in (self.database_path, f"{self.database_path}-wal")
+                   if os.path.exists(path))
+
+    @staticmethod
+    def ensure_occurrences(cursor):
+        """Колонка числа повторов (ChatterBot о ней не знает, новые записи получают 1)"""
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(statement)")]
+        if 'occurrences' not in columns:
+            cursor.execute("ALTER TABLE statement ADD COLUMN occurrences INTEGER NOT NULL DEFAULT 1")
+
+    @staticmethod
+    def deduplicate(cursor):
+        """Сворачивание одинаковых записей в самую свежую; число удаленных строк"""
+        cursor.execute("""
+            CREATE TEMP TABLE fc_duplicates AS
+            SELECT statement.id AS id, groups.keep_id AS keep_id, statement.occurrences AS occurrences
+            FROM statement JOIN (
+                SELECT max(id) AS keep_id, text, in_response_to, persona FROM statement
+                GROUP BY text, in_response_to, persona HAVING count(*) > 1
+            ) AS groups
+            ON statement.text IS groups.text AND statement.in_response_to IS groups.in_response_to
+               AND statement.persona = groups.persona AND statement.id != groups.keep_id
+        """)
+        cursor.execute("CREATE INDEX temp.fc_duplicates_keep ON fc_duplicates (keep_id)")
+        cursor.execute("""
+            UPDATE statement SET occurrences = occurrences + (
+                SELECT sum(occurrences) FROM fc_duplicates WHERE fc_duplicates.keep_id = statement.id
+            ) WHERE id IN (SELECT keep_id FROM fc_duplicates)
+        """)
+        cursor.execute("""
+            INSERT INTO tag_association (tag_id, statement_id)
+            SELECT DISTINCT tag_association.tag_id, fc_duplicates.keep_id
+            FROM tag_association JOIN fc_duplicates ON tag_association.statement_id = fc_duplicates.id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM tag_association AS kept
+                WHERE kept.tag_id = tag_association.tag_id AND kept.statement_id = fc_duplicates.keep_id
+            )
+        """)
+        cursor.execute("DELETE FROM tag_association WHERE statement_id IN (SELECT id FROM fc_duplicates)")
+        cursor.execute("DELETE FROM statement WHERE id IN (SELECT id FROM fc_duplicates)")
+        removed = cursor.rowcount
+        cursor.execute("DROP TABLE fc_duplicates")
+        return removed
+
+    def apply_retention(self, cursor):
+        """Удаление устаревших выученных записей; число удаленных строк"""
+        if self.retention_days <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        cursor.execute(
+            "DELETE FROM statement WHERE conversation != 'training' AND created_at < ? "
+            "AND (in_response_to IS NULL OR occurrences < ?)",
+            (cutoff, self.keep_occurrences)
+        )
+        removed = cursor.rowcount
+        if removed:
+            cursor.execute("DELETE FROM tag_association WHERE statement_id NOT IN (SELECT id FROM statement)")
+        return removed
+
+    def vacuum(self, connection, full_vacuum=False):
+        """Возврат свободных страниц порциями; (режим, освобождено страниц)
+
+        Инкрементальный режим на существующей базе включается только полным
+        VACUUM, который держит базу заблокированной на все время перезаписи.
+        Его выполняет лишь full_vacuum (команда maintain), без него VACUUM
+        пропускается, пока база не переведена в этот режим.
+        """
+        cursor = connection.cursor()
+        try:
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                if not full_vacuum:
+                    return 'skipped', 0
+                cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                cursor.execute("VACUUM")
+                return 'full', pages
+            
+            freed = 0
+            while True:
+                pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                if not pages:
+                    break
+                cursor.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+                connection.commit()
+                freed += min(pages, self.vacuum_pages)
+            return 'incremental', freed
+        finally:
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            cursor.close()
+
+    def run_once(self, dry_run=False, full_vacuum=False):
+        """Один проход обслуживания с отчетом
+
+        dry_run - только подсчет, без изменений; full_vacuum - разрешить
+        полный VACUUM для перевода базы в инкрементальный режим.
+        """
+        with self.lock:
+            started = time.perf_counter()
+            report = {'dry_run': dry_run, 'size_bytes_before': self.database_size()}
+            connection = self.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                report['rows_before'] = cursor.execute("SELECT count(*) FROM statement").fetchone()[0]
+                # Образцы - из выученных записей: разговор 'training' ChatterBot целиком не читает
+                probes = cursor.execute(
+                    "SELECT text, search_text, conversation, in_response_to, search_in_response_to FROM statement "
+                    "ORDER BY conversation = 'training', random() LIMIT ?", (MAINTENANCE_PROBES,)
+                ).fetchall()
+                if probes:
+                    report['latency_before'] = time_statement_queries(connection, probes)
+                
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    self.ensure_occurrences(cursor)
+                    report['duplicates_removed'] = self.deduplicate(cursor)
+                    report['retention_removed'] = self.apply_retention(cursor)
+                    report['rows_after'] = cursor.execute("SELECT count(*) FROM statement").fetchone()[0]
+                except BaseException:
+                    connection.rollback()
+                    raise
+                if dry_run:
+                    connection.rollback()
+                else:
+                    connection.commit()
+                cursor.close()
+                
+                if not dry_run:
+                    report['vacuum'], report['pages_freed'] = self.vacuum(connection, full_vacuum)
+                    if probes:
+                        report['latency_after'] = time_statement_queries(connection, probes)
+            finally:
+                connection.close()
+            
+            report['size_bytes_after'] = self.database_size()
+            report['seconds'] = round(time.perf_counter() - started, 3)
+            self.last_report = report
+        
+        removed = report['duplicates_removed'] + report['retention_removed']
+        if removed and not dry_run and self.on_change:
+            self.on_change(report)
+        return report
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='statement-maintenance', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped:
+                    self.condition.wait(self.interval)
+                if self.stopped:
+                    return
+            try:
+                report = self.run_once()
+                print(f"🧹 Обслуживание базы: -{report['duplicates_removed']} дубликатов, "
+                      f"-{report['retention_removed']} устаревших записей за {report['seconds']} с")
+                if report['vacuum'] == 'skipped':
+                    print("⚠️ VACUUM пропущен: база не в инкрементальном режиме, один раз выполни python main.py maintain")
+            except Exception as e:
+                print(f"⚠️ Ошибка обслуживания базы: {e}")
+
+
+class KeywordHits:
+    """Результат одного прохода автомата: баллы меток во всех таблицах ключевых слов"""
+
+    __slots__ = ('scores', 'tables')
+
+    def __init__(self, scores, tables):
+        self.scores = scores
+        self.tables = tables
+
+    def score(self, table, label):
+        return self.scores.get(table, {}).get(label, 0)
+
+    def first(self, table, default=None):
+        """Первая по порядку таблицы метка, у которой есть совпадение"""
+        table_scores = self.scores.get(table)
+        if table_scores:
+            for label in self.tables[table]:
+                if table_scores.get(label):
+                    return label
+        return default
+
+    def best(self, table, default=None):
+        """Метка с максимальным баллом (при равенстве - первая по порядку)"""
+        table_scores = self.scores.get(table)
+        if not table_scores:
+            return default
+        return max(self.tables[table], key=lambda label: table_scores.get(label, 0))
+
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик для всех таблиц ключевых слов анализаторов
+
+    Таблица - это упорядоченный словарь метка -> список ключевых слов (с весом).
+    Автомат строится один раз, а scan() за один проход по тексту находит
+    все ключевые слова сразу и возвращает баллы меток каждой таблицы.
+    Семантика совпадает с `keyword in text`: каждое слово учитывается один раз.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.entries = []
+        self.keyword_ids = {}
+        self.tables = {}
+
+    def add_table(self, table, mapping, weights=None):
+        """Добавление таблицы: метка -> ключевые слова, weights: метка -> вес"""
+        self.tables[table] = list(mapping)
+        for label, keywords in mapping.items():
+            weight = weights[label] if weights else 1
+            for keyword in keywords:
+                self.add_keyword(keyword).append((table, label, weight))
+
+    def add_keyword(self, keyword):
+        if keyword in self.keyword_ids:
+            return self.entries[self.keyword_ids[keyword]]
+
+        keyword_id = len(self.entries)
+        self.keyword_ids[keyword] = keyword_id
+        self.entries.append([])
+
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(keyword_id)
+
+        return self.entries[keyword_id]
+
+    def compile(self):
+        """Построение суффиксных ссылок и полной таблицы переходов (ДКА)"""
+        # Переходы из корня ссылаются на корень
+        order = []
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+        
+        # Сворачиваем суффиксные ссылки в переходы, чтобы scan() делал один шаг на символ
+        self.delta = [dict(transitions) for transitions in self.goto]
+        for state in order:
+            for char, next_state in self.delta[self.fail[state]].items():
+                self.delta[state].setdefault(char, next_state)
+        self.output = [tuple(keyword_ids) for keyword_ids in self.output]
+        return self
+
+    def scan(self, text):
+        """Один проход по тексту: баллы всех таблиц"""
+        delta, output = self.delta, self.output
+        found = set()
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+
+        scores = {}
+        for keyword_id in found:
+            for table, label, weight in self.entries[keyword_id]:
+                table_scores = scores.setdefault(table, {})
+                table_scores[label] = table_scores.get(label, 0) + weight
+
+        return KeywordHits(scores, self.tables)
+
+
+class ParsedInput:
+    """Сообщение пользователя, разобранное один раз на весь запрос
+
+    Анализаторы получают этот объект вместо строки и берут готовые формы:
+    нижний регистр, текст без пунктуации, токены, символьные n-граммы и
+    совпадения ключевых слов (считаются лениво при первом обращении).
+    Сюда же кладутся результаты семантического поиска (в пакете - заранее).
+    key - ключ кэша ответов: как normalized, но с арифметическими знаками,
+    иначе "2+3", "2*3" и "23" получили бы один ответ.
+    """
+
+    __slots__ = ('text', 'lower', 'normalized', 'key', 'tokens', 'token_set', 'char_grams', 'hits', 'semantic')
+
+    def __init__(self, text):
+        self.text = text
+        self.lower = text.lower()
+        self.normalized = re.sub(r'[^\w\s]', '', self.lower).strip()
+        self.key = ' '.join(re.sub(r'[^\w\s+\-*/:().×÷]', '', self.lower).split()).rstrip('.:')
+        self.tokens = self.lower.split()
+        self.token_set = frozenset(self.tokens)
+        self.char_grams = {}
+        self.hits = None
+        self.semantic = None
+
+    @classmethod
+    def of(cls, value):
+        """Разобранный ввод из строки или уже готового объекта"""
+        return value if isinstance(value, cls) else cls(value)
+
+    def grams(self, size):
+        """Символьные n-граммы текста без пунктуации"""
+        grams = self.char_grams.get(size)
+        if grams is None:
+            text = self.normalized
+            grams = self.char_grams[size] = {text[i:i + size] for i in range(len(text) - size + 1)}
+        return grams
+
+    def __str__(self):
+        return self.text
+
+
+class FallbackKnowledgeIndex:
+    """Индекс базы знаний для get_fallback_response
+
+    Семантика совпадает с линейным перебором: побеждает первый по порядку
+    вариант паттерна, для которого `variant in input or input in variant`.
+    Кандидаты находятся по n-граммам (n <= 3) вместо обхода всех записей:
+    - variant in input: каждый вариант индексируется по одной "якорной"
+      (самой редкой) n-грамме, которая обязана встретиться во входе;
+    - input in variant: все n-граммы входа обязаны быть в варианте,
+      поэтому достаточно самого короткого списка вхождений.
+    После этого короткий список кандидатов проверяется точным сравнением.
+    """
+
+    GRAM_SIZE = 3
+
+    def __init__(self, knowledge=()):
+        self.keys = []
+        self.variants = []
+        self.postings = defaultdict(list)
+        self.anchors = defaultdict(list)
+        self.empty = []
+        self.anchor_sizes = set()
+        self.max_variant_length = 0
+        for key in knowledge:
+            self.add(key)
+
+    @staticmethod
+    def grams(text, size):
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def add(self, key):
+        """Добавление нового паттерна (в конец порядка, как в словаре)"""
+        entry = len(self.keys)
+        self.keys.append(key)
+
+        for position, variant in enumerate(v.strip().lower() for v in key.split('|')):
+            variant_id = len(self.variants)
+            self.variants.append(((entry, position), variant))
+
+            if not variant:
+                self.empty.append(variant_id)
+                continue
+
+            for size in range(1, self.GRAM_SIZE + 1):
+                for gram in self.grams(variant, size):
+                    self.postings[gram].append(variant_id)
+
+            if len(variant) < self.GRAM_SIZE:
+                anchor = variant
+            else:
+                anchor = min(sorted(self.grams(variant, self.GRAM_SIZE)), key=lambda gram: len(self.postings[gram]))
+            self.anchors[anchor].append(variant_id)
+            self.anchor_sizes.add(len(anchor))
+            self.max_variant_length = max(self.max_variant_length, len(variant))
+
+    def lookup(self, normalized_input, grams=None):
+        """Ключ первого подходящего паттерна или None
+
+        grams(size) - готовые n-граммы входа (например, ParsedInput.grams).
+        """
+        if not normalized_input:
+            # Пустая строка содержится в любом варианте
+            return self.keys[0] if self.keys else None
+
+        if grams is None:
+            grams = lambda size: self.grams(normalized_input, size)
+        candidates = set(self.empty)
+
+        # variant in input: якорь варианта есть среди n-грамм входа
+        for size in self.anchor_sizes:
+            for gram in grams(size):
+                candidates.update(self.anchors.get(gram, ()))
+
+        # input in variant: вариант есть в каждом списке n-грамм входа
+        if len(normalized_input) <= self.max_variant_length:
+            size = min(self.GRAM_SIZE, len(normalized_input))
+            postings = [self.postings.get(gram) for gram in grams(size)]
+            if all(postings):
+                candidates.update(min(postings, key=len))
+
+        best = None
+        for variant_id in candidates:
+            order, variant = self.variants[variant_id]
+            if best is not None and order >= best:
+                continue
+            if variant in normalized_input or normalized_input in variant:
+                best = order
+
+        return self.keys[best[0]] if best else None
+
+
+class SemanticIndex:
+    """TF-IDF индекс документов на хэширующем векторизаторе
+
+    Словарь не обучается: признаки - хэши n-грамм, поэтому новый документ
+    добавляется за O(длины документа). Его строка взвешивается текущими
+    частотами документов и попадает в хвост pending; фоновое уплотнение
+    пересчитывает IDF для всей матрицы и сохраняет ее на диск.
+    """
+
+    VERSION = 2
+
+    def __init__(self, vectorizer, path=SEMANTIC_INDEX_PATH,
+                 compact_interval=SEMANTIC_COMPACT_INTERVAL, compact_threshold=SEMANTIC_COMPACT_THRESHOLD):
+        self.path = path
+        self.vectorizer = vectorizer
+        self.compact_interval = compact_interval
+        self.compact_threshold = compact_threshold
+        self.documents = []
+        self.known = set()
+        self.df = np.zeros(vectorizer.n_features, dtype=np.int64)
+        self.analyzer = vectorizer.build_analyzer()
+        self.counts = None
+        self.matrix = None
+        self.matrix_t = None
+        self.pending_counts = []
+        self.pending_matrix = None
+        self.pending_t = None
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.compactions = 0
+        self.thread = None
+
+    def build(self, documents, state=None):
+        """Загрузка сохраненного индекса и догрузка новых документов; True - если собран заново
+
+        state - готовое состояние (например, из снимка), иначе читается файл индекса.
+        """
+        documents = list(dict.fromkeys(documents))
+        loaded = (state is not None and self.restore(state)) or self.load()
+        if loaded:
+            current = set(documents)
+            if any(document not in current for document in self.documents):
+                # Документы удалялись - частоты устарели, собираем заново
+                self.reset()
+                loaded = False
+        
+        self.add_many(documents)
+        if not loaded:
+            self.compact()
+        return not loaded
+
+    def rebuild(self, documents):
+        """Пересборка по актуальным документам после удаления записей из базы
+
+        Новая матрица строится в стороннем объекте, поиск до подмены идет
+        по старой; документы, добавленные за это время, переносятся.
+        """
+        with self.compact_lock:
+            with self.lock:
+                start = len(self.documents)
+            rebuilt = SemanticIndex(self.vectorizer, self.path)
+            rebuilt.add_many(documents)
+            rebuilt.compact()
+            with self.lock:
+                rebuilt.add_many(self.documents[start:])
+                (self.documents, self.known, self.df, self.counts, self.matrix, self.matrix_t,
+                 self.pending_counts, self.pending_matrix, self.pending_t) = (
+                    rebuilt.documents, rebuilt.known, rebuilt.df, rebuilt.counts, rebuilt.matrix, rebuilt.matrix_t,
+                    rebuilt.pending_counts, rebuilt.pending_matrix, rebuilt.pending_t)
+        return len(self.documents)
+
+    def reset(self):
+        self.documents = []
+        self.known = set()
+        self.df[:] = 0
+        self.counts = None
+        self.matrix = None
+        self.matrix_t = None
+        self.pending_counts = []
+        self.pending_matrix = None
+        self.pending_t = None
+
+    def weigh(self, counts):
+        """TF-IDF строки по текущим частотам документов (сглаженный IDF, L2-норма)"""
+        weighted = counts.astype(np.float64)
+        total = len(self.documents)
+        weighted.data *= np.log((1 + total) / (1 + self.df[weighted.indices])) + 1
+        return normalize(weighted)
+
+    def add_many(self, documents):
+        """Добавление документов (текст, запись) без пересчета всей матрицы"""
+        with self.lock:
+            documents = [document for document in dict.fromkeys(documents) if document not in self.known]
+            if not documents:
+                return 0
+            
+            counts = self.vectorizer.transform([text for text, _ in documents]).tocsr()
+            counts.sum_duplicates()
+            self.documents.extend(documents)
+            self.known.update(documents)
+            np.add.at(self.df, counts.indices, 1)
+            
+            rows = self.weigh(counts)
+            self.pending_counts.append(counts)
+            if self.pending_matrix is None:
+                self.pending_matrix = rows
+            else:
+                self.pending_matrix = sp.vstack([self.pending_matrix, rows], format='csr')
+            self.pending_t = self.pending_matrix.T.tocsr()
+            pending = self.pending_matrix.shape[0]
+        
+        if pending >= self.compact_threshold:
+            with self.condition:
+                self.condition.notify()
+        return len(documents)
+
+    def add(self, text, entry):
+        return self.add_many([(text, entry)])
+
+    def pending_rows(self):
+        pending = self.pending_matrix
+        return pending.shape[0] if pending is not None else 0
+
+    def compact(self):
+        """Вливание хвоста pending в основную матрицу с пересчитанным IDF"""
+        with self.compact_lock:
+            with self.lock:
+                blocks = list(self.pending_counts)
+                if not blocks:
+                    return 0
+                base = self.counts
+                df = self.df.copy()
+                total = len(self.documents)
+            
+            counts = sp.vstack(([base] if base is not None else []) + blocks, format='csr')
+            idf = np.log((1 + total) / (1 + df)) + 1
+            matrix = normalize(counts.multiply(idf).tocsr())
+            matrix_t = matrix.T.tocsr()
+            
+            with self.lock:
+                # Документы, добавленные во время уплотнения, остаются в хвосте
+                rest = self.pending_counts[len(blocks):]
+                self.counts, self.matrix, self.matrix_t = counts, matrix, matrix_t
+                self.pending_counts = rest
+                self.pending_matrix = self.weigh(sp.vstack(rest, format='csr')) if rest else None
+                self.pending_t = self.pending_matrix.T.tocsr() if rest else None
+            
+            self.compactions += 1
+            self.save()
+            return sum(block.shape[0] for block in blocks)
+
+    def state(self):
+        """Уплотненная часть индекса: документы, частоты документов и матрицы"""
+        with self.lock:
+            state = {
+                'version': self.VERSION,
+                'n_features': self.vectorizer.n_features,
+                'documents': self.documents[:self.counts.shape[0]],
+                'df': self.df.copy(),
+                'counts': self.counts,
+                'matrix': self.matrix,
+                'matrix_t': self.matrix_t
+            }
+            # Частоты хвоста pending не сохраняем - он догрузится при старте
+            for block in self.pending_counts:
+                np.subtract.at(state['df'], block.indices, 1)
+        return state
+
+    def restore(self, state):
+        """Установка сохраненного состояния; False - другая версия или размерность"""
+        if state.get('version') != self.VERSION or state.get('n_features') != self.vectorizer.n_features:
+            return False
+        self.documents = list(state['documents'])
+        self.known = set(self.documents)
+        # Частоты дописываются на месте, поэтому всегда берем свою копию
+        self.df = np.array(state['df'])
+        self.counts = state['counts']
+        self.matrix = state['matrix']
+        matrix_t = state.get('matrix_t')
+        self.matrix_t = matrix_t if matrix_t is not None else self.matrix.T.tocsr()
+        return True
+
+    def load(self):
+        """Загрузка сохраненной матрицы и частот документов"""
+        try:
+            if not os.path.exists(self.path):
+                return False
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            return self.restore(state)
+        except Exception as e:
+            print(f"⚠️ Семантический индекс поврежден, будет пересобран: {e}")
+            self.reset()
+            return False
+
+    def save(self):
+        """Атомарное сохранение уплотненной части индекса"""
+        state = self.state()
+        # Транспонированная матрица восстанавливается при загрузке
+        del state['matrix_t']
+        try:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить семантический индекс: {e}")
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='semantic-compactor', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Остановка потока с финальным уплотнением"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.compact_interval + 5)
+        self.compact()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and self.pending_rows() < self.compact_threshold:
+                    self.condition.wait(self.compact_interval)
+                if self.stopped:
+                    return
+            self.compact()
+
+    def feature(self, term):
+        """Номер признака термина - тот же, что дает HashingVectorizer"""
+        h = murmurhash3_32(term, seed=0)
+        if h == -2 ** 31:
+            return (2 ** 31 - 1 - (self.vectorizer.n_features - 1)) % self.vectorizer.n_features
+        return abs(h) % self.vectorizer.n_features
+
+    def query(self, text):
+        """TF-IDF вектор запроса как пара массивов (признаки, веса)"""
+        counts = defaultdict(int)
+        for term in self.analyzer(text):
+            counts[self.feature(term)] += 1
+        features = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        if len(features):
+            total = len(self.documents)
+            weights *= np.log((1 + total) / (1 + self.df[features])) + 1
+            weights /= np.sqrt(weights @ weights)
+        return features, weights
+
+    @staticmethod
+    def scores(matrix_t, features, weights):
+        """Косинусы со всеми документами по транспонированной матрице (признак -> документы)"""
+        scores = np.zeros(matrix_t.shape[1])
+        indptr, indices, data = matrix_t.indptr, matrix_t.indices, matrix_t.data
+        for feature, weight in zip(features, weights):
+            start, end = indptr[feature], indptr[feature + 1]
+            if start != end:
+                scores[indices[start:end]] += weight * data[start:end]
+        return scores
+
+    def search(self, text, top_k=SEMANTIC_TOP_K):
+        """Лучшие записи по косинусной близости: [(оценка, запись), ...]"""
+        with self.lock:
+            features, weights = self.query(text)
+            parts = [matrix for matrix in (self.matrix_t, self.pending_t) if matrix is not None]
+            documents = self.documents
+        if not len(features) or not parts:
+            return []
+        
+        # Строки нормированы, сумма произведений по общим признакам - это косинус
+        scores = np.concatenate([self.scores(matrix, features, weights) for matrix in parts])
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), documents[i][1]) for i in top if scores[i] > 0]
+
+    def search_many(self, texts, top_k=SEMANTIC_TOP_K):
+        """Поиск для пачки запросов одним произведением разреженных матриц"""
+        with self.lock:
+            queries = [self.query(text) for text in texts]
+            parts = [matrix for matrix in (self.matrix_t, self.pending_t) if matrix is not None]
+            documents = self.documents
+        if not queries or not parts:
+            return [[] for _ in texts]
+        
+        # Строки запросов -> матрица (запросы x признаки), умножение дает косинусы со всеми документами
+        indptr = np.cumsum([0] + [len(features) for features, _ in queries])
+        matrix_q = sp.csr_matrix(
+            (np.concatenate([weights for _, weights in queries]), np.concatenate([features for features, _ in queries]), indptr),
+            shape=(len(queries), self.vectorizer.n_features)
+        )
+        scores = sp.hstack([matrix_q @ matrix for matrix in parts], format='csr')
+        
+        results = []
+        for row in range(len(queries)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            data, indices = scores.data[start:end], scores.indices[start:end]
+            k = min(top_k, len(data))
+            if not k:
+                results.append([])
+                continue
+            top = np.argpartition(-data, k - 1)[:k]
+            top = top[np.argsort(-data[top])]
+            results.append([(float(data[i]), documents[indices[i]][1]) for i in top if data[i] > 0])
+        return results
+
+
+class KnowledgeJournal:
+    """Журнал базы знаний: снимок JSON плюс дописываемый JSONL-журнал
+
+    Каждое обучение - одна строка в журнале (O(1) вместо перезаписи всего
+    JSON); fsync выполняется пакетами раз в fsync_interval секунд. Когда в
+    журнале накапливается compact_entries записей, фоновый поток атомарно
+    пишет новый снимок и обнуляет журнал. Если процесс упадет между этими
+    шагами, повторное проигрывание журнала пропускает уже известные записи.
+    """
+
+    def __init__(self, path=KNOWLEDGE_PATH, journal_path=KNOWLEDGE_JOURNAL_PATH,
+                 fsync_interval=KNOWLEDGE_FSYNC_INTERVAL, compact_entries=KNOWLEDGE_COMPACT_ENTRIES):
+        self.path = path
+        self.journal_path = journal_path
+        self.fsync_interval = fsync_interval
+        self.compact_entries = compact_entries
+        self.knowledge = {}
+        self.journal = None
+        self.entries = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def load(self):
+        """Снимок с проигранным поверх журналом"""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.knowledge = json.load(f)
+        except Exception as e:
+            print(f"Ошибка загрузки знаний: {e}")
+            self.knowledge = {}
+        
+        self.entries = 0
+        if os.path.exists(self.journal_path):
+            offset, torn = 0, False
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('нет конца строки')
+                        entry = json.loads(line)
+                    except ValueError:
+                        torn = True
+                        break
+                    responses = self.knowledge.setdefault(entry['topic'], [])
+                    if entry['info'] not in responses:
+                        responses.append(entry['info'])
+                    self.entries += 1
+                    offset += len(line)
+            if torn:
+                # Оборванная запись после сбоя: отрезаем, чтобы новые строки не склеились с ней
+                print("⚠️ Журнал знаний обрезан, поврежденная запись удалена")
+                os.truncate(self.journal_path, offset)
+        return self.knowledge
+
+    def open(self):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        return self.journal
+
+    def append(self, topic, info):
+        """Дописывание одной записи обучения в журнал"""
+        with self.lock:
+            journal = self.open()
+            journal.write(json.dumps({'topic': topic, 'info': info}, ensure_ascii=False) + '\n')
+            journal.flush()
+            self.entries += 1
+            self.dirty = True
+            entries = self.entries
+        
+        if entries >= self.compact_entries:
+            with self.condition:
+                self.condition.notify()
+
+    def sync(self):
+        """fsync накопленных записей журнала"""
+        with self.lock:
+            if self.dirty and self.journal is not None:
+                os.fsync(self.journal.fileno())
+                self.dirty = False
+
+    def compact(self):
+        """Атомарная запись снимка и обнуление журнала"""
+        with self.lock:
+            # Копия словаря в CPython атомарна и защищает от изменения во время записи
+            snapshot = {topic: list(responses) for topic, responses in self.knowledge.copy().items()}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            with open(self.journal_path, 'w', encoding='utf-8') as f:
+                os.fsync(f.fileno())
+            self.entries = 0
+            self.dirty = False
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='knowledge-journal', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Остановка потока с финальным fsync"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.fsync_interval + 5)
+        self.sync()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and self.entries < self.compact_entries:
+                    self.condition.wait(self.fsync_interval)
+                if self.stopped:
+                    return
+            try:
+                if self.entries >= self.compact_entries:
+                    self.compact()
+                else:
+                    self.sync()
+            except Exception as e:
+                print(f"⚠️ Ошибка записи журнала знаний: {e}")
 
-app = Flask(__name__)
 
-class WebAdvancedFutureChat:
+class WarmStateSnapshot:
+    """Снимок производного состояния для быстрого запуска процессов
+
+    Формат файла: магическая строка, длина и JSON-заголовок (версия формата,
+    хэши исходников, таблица массивов), затем выровненные сырые массивы и
+    pickle остальных объектов. Файл отображается в память через mmap:
+    массивы (постинги индекса ChatterBot, матрицы семантического индекса)
+    становятся представлениями без копирования, и их страницы общие для
+    всех процессов, открывших снимок. Снимок устаревает при изменении кода
+    (таблицы ключевых слов и энциклопедия живут в нем) или файлов знаний.
+    """
+
+    MAGIC = b'FCWARM\x00\x01'
+    VERSION = 1
+    ALIGN = 64
+
+    def __init__(self, path=WARM_STATE_PATH):
+        self.path = path
+        self.header = None
+        self.buffer = None
+        self.data = 0
+        self.objects = {}
+
+    @staticmethod
+    def digest(*paths):
+        """sha256 содержимого файлов (отсутствующий файл - пустой)"""
+        digest = hashlib.sha256()
+        for path in paths:
+            content = b''
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    content = f.read()
+            digest.update(len(content).to_bytes(8, 'little'))
+            digest.update(content)
+        return digest.hexdigest()
+
+    @classmethod
+    def sources(cls):
+        """Хэши исходников, из которых вычисляется состояние"""
+        return {
+            'code': cls.digest(os.path.abspath(__file__)),
+            'knowledge': cls.digest(KNOWLEDGE_PATH, KNOWLEDGE_JOURNAL_PATH),
+            'platform': f"{sys.byteorder}-{struct.calcsize('P') * 8}"
+        }
+
+    def align(self, offset):
+        return offset + -offset % self.ALIGN
+
+    def open(self, sources):
+        """Отображение файла в память и проверка версии и хэшей; False - снимок не подходит"""
+        try:
+            with open(self.path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        try:
+            if buffer[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError('неизвестный формат файла')
+            start = len(self.MAGIC) + 8
+            (length,) = struct.unpack_from('<Q', buffer, len(self.MAGIC))
+            header = json.loads(buffer[start:start + length])
+            if header['version'] != self.VERSION:
+                raise ValueError(f"версия {header['version']}, нужна {self.VERSION}")
+            if header['sources'] != sources:
+                print("♻️ Снимок состояния устарел (изменились код или знания), состояние будет вычислено")
+                buffer.close()
+                return False
+            data = self.align(start + length)
+            offset, size = header['objects']
+            objects = pickle.loads(buffer[data + offset:data + offset + size])
+        except Exception as e:
+            print(f"⚠️ Снимок состояния поврежден, состояние будет вычислено: {e}")
+            buffer.close()
+            return False
+
+        self.buffer, self.header, self.data, self.objects = buffer, header, data, objects
+        return True
+
+    def array(self, name):
+        """Массив как memoryview поверх mmap (только чтение, без копирования)"""
+        fmt, offset, count = self.header['arrays'][name]
+        start = self.data + offset
+        return memoryview(self.buffer)[start:start + count * struct.calcsize(fmt)].cast(fmt)
+
+    def ndarray(self, name):
+        view = self.array(name)
+        return np.frombuffer(view, dtype=view.format)
+
+    def matrix(self, name, shape):
+        """Разреженная CSR-матрица поверх массивов снимка"""
+        parts = tuple(self.ndarray(f'{name}.{part}') for part in ('data', 'indices', 'indptr'))
+        return sp.csr_matrix(parts, shape=tuple(shape), copy=False)
+
+    @staticmethod
+    def put_matrix(arrays, name, matrix):
+        """Раскладка CSR-матрицы на массивы снимка; возвращает форму для заголовка"""
+        arrays[f'{name}.data'] = matrix.data
+        arrays[f'{name}.indices'] = matrix.indices
+        arrays[f'{name}.indptr'] = matrix.indptr
+        return list(matrix.shape)
+
+    def write(self, sources, objects, arrays):
+        """Атомарная запись снимка; arrays - имя -> одномерный массив с буферным протоколом"""
+        table, chunks, offset = {}, [], 0
+        for name, values in arrays.items():
+            view = memoryview(values)
+            padding = self.align(offset) - offset
+            chunks.append(bytes(padding))
+            table[name] = [view.format, offset + padding, len(view)]
+            chunks.append(view.cast('B'))
+            offset += padding + view.nbytes
+
+        blob = pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL)
+        header = {
+            'version': self.VERSION,
+            'sources': sources,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'arrays': table,
+            'objects': [offset, len(blob)]
+        }
+        encoded = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        start = len(self.MAGIC) + 8
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack('<Q', len(encoded)))
+            f.write(encoded)
+            f.write(bytes(self.align(start + len(encoded)) - start - len(encoded)))
+            for chunk in chunks:
+                f.write(chunk)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        # Работающие процессы держат отображение старого файла - его заменяем, а не перезаписываем
+        os.replace(tmp_path, self.path)
+        return header
+
+    @staticmethod
+    def restore_object(cls, state):
+        """Объект класса из словаря атрибутов (классы в снимок не попадают)"""
+        instance = cls.__new__(cls)
+        instance.__dict__.update(state)
+        return instance
+
+
+class ArithmeticLimitError(ValueError):
+    """Выражение недопустимо или превышает лимиты вычислителя"""
+
+
+class SafeArithmetic:
+    """Арифметика по AST вместо eval: только числа, скобки и + - * / // % **
+
+    Размер операндов и результата ограничен числом десятичных знаков (оценка
+    делается до умножения и возведения в степень), число операций и время
+    вычисления тоже ограничены, поэтому задержка предсказуема. number_type
+    Fraction или Decimal дает точный результат вместо float.
+    """
+
+    OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+    }
+    UNARY_OPERATORS = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+    }
+
+    def __init__(self, number_type=None, max_digits=MATH_MAX_DIGITS,
+                 max_operations=MATH_MAX_OPERATIONS, time_budget=MATH_TIME_BUDGET):
+        self.number_type = number_type
+        self.max_digits = max_digits
+        self.max_operations = max_operations
+        self.time_budget = time_budget
+
+    def evaluate(self, expression):
+        """Значение выражения; ArithmeticLimitError при нарушении лимитов"""
+        if len(expression) > MATH_MAX_EXPRESSION_LENGTH:
+            raise ArithmeticLimitError("слишком длинное выражение")
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except (SyntaxError, RecursionError, MemoryError) as e:
+            raise ArithmeticLimitError(f"не выражение: {e}")
+        
+        budget = [self.max_operations, time.perf_counter() + self.time_budget]
+        if self.number_type is Decimal:
+            with localcontext() as context:
+                context.prec = MATH_DECIMAL_PRECISION
+                return self.visit(tree.body, budget)
+        return self.visit(tree.body, budget)
+
+    def number(self, value):
+        if self.number_type is None or isinstance(value, self.number_type):
+            return value
+        # Через строку, чтобы 0.1 стало ровно 1/10, а не двоичной дробью
+        return self.number_type(str(value))
+
+    @staticmethod
+    def digits(value):
+        """Оценка числа десятичных знаков (float ограничен сам по себе)"""
+        if isinstance(value, int):
+            return value.bit_length() * 0.30103
+        if isinstance(value, Fraction):
+            return max(value.numerator.bit_length(), value.denominator.bit_length()) * 0.30103
+        if isinstance(value, Decimal) and value.is_finite() and value:
+            return abs(value.adjusted()) + 1
+        return 0
+
+    def check_operation(self, op, left, right):
+        """Отсечение операций, результат которых заведомо превысит лимит"""
+        if op is ast.Mult and self.digits(left) + self.digits(right) > self.max_digits:
+            raise ArithmeticLimitError("слишком большое произведение")
+        if op is ast.Pow and not isinstance(left, float) and not isinstance(right, float):
+            # Размер результата оцениваем до pow: дробь в степени растет так же,
+            # как целое (0.5**n точно - это 1/2**n). Только 0 и ±1 не растут.
+            # Целое в отрицательной степени - маленький float, а у точных
+            # Fraction и Decimal растет знаменатель, их проверяем и тут.
+            # Показатель проверяем по числу знаков до перевода в float
+            exact = isinstance(left, (Fraction, Decimal))
+            if left not in (0, 1, -1) and (right > 0 or (right < 0 and exact)) and (
+                    self.digits(right) > 15 or self.digits(left) * abs(float(right)) > self.max_digits):
+                raise ArithmeticLimitError("слишком большая степень")
+
+    def visit(self, node, budget):
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise ArithmeticLimitError("слишком много операций")
+        if time.perf_counter() > budget[1]:
+            raise ArithmeticLimitError("превышено время вычисления")
+        
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = self.number(node.value)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY_OPERATORS:
+            value = self.UNARY_OPERATORS[type(node.op)](self.visit(node.operand, budget))
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.OPERATORS:
+            left = self.visit(node.left, budget)
+            right = self.visit(node.right, budget)
+            self.check_operation(type(node.op), left, right)
+            try:
+                value = self.OPERATORS[type(node.op)](left, right)
+            except OverflowError:
+                raise ArithmeticLimitError("слишком большое число")
+        else:
+            raise ArithmeticLimitError(f"недопустимый элемент: {type(node).__name__}")
+        
+        if self.digits(value) > self.max_digits:
+            raise ArithmeticLimitError("слишком большое число")
+        return value
+
+
+class HistoryRecord:
+    """Одна реплика в истории разговора"""
+
+    __slots__ = ('user', 'bot', 'source', 'timestamp')
+
+    def __init__(self, user, bot, source, timestamp):
+        self.user = user
+        self.bot = bot
+        self.source = source
+        self.timestamp = timestamp
+
+    def size(self):
+        """Оценка занимаемой памяти в байтах"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.user) + sys.getsizeof(self.bot) +
+                sys.getsizeof(self.source) + sys.getsizeof(self.timestamp))
+
+
+class ConversationSession:
+    __slots__ = ('history', 'size', 'last_seen')
+
+    def __init__(self, history_length):
+        self.history = deque(maxlen=history_length)
+        self.size = 0
+        self.last_seen = time.monotonic()
+
+
+class SessionStore:
+    """История разговоров по сессиям
+
+    У каждой сессии свой кольцевой буфер deque фиксированной длины, поэтому
+    добавление реплики - O(1) без копирования списка. Сессии хранятся в
+    порядке последнего обращения: простаивающие дольше idle_timeout и самые
+    давние сверх max_sessions или memory_limit байт вытесняются первыми.
+    """
+
+    def __init__(self, history_length=SESSION_HISTORY_LENGTH, max_sessions=SESSION_MAX_COUNT,
+                 memory_limit=SESSION_MEMORY_LIMIT, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.history_length = history_length
+        self.max_sessions = max_sessions
+        self.memory_limit = memory_limit
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        # Пустая сессия: буфер, объект и запись словаря с ключом
+        self.session_overhead = (sys.getsizeof(deque(maxlen=history_length)) +
+                                 sys.getsizeof(ConversationSession(history_length)) + 200)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def recent(self, session_id, count):
+        """Последние count реплик сессии (копия, безопасная для чтения)"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            self.sessions.move_to_end(session_id)
+            session.last_seen = time.monotonic()
+            history = session.history
+            return [history[i] for i in range(max(0, len(history) - count), len(history))]
+
+    def append(self, session_id, user, bot, source):
+        """Добавление реплики в кольцевой буфер сессии"""
+        record = HistoryRecord(user, bot, source, time.time())
+        record_size = record.size()
+        
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = ConversationSession(self.history_length)
+                session.size = self.session_overhead + sys.getsizeof(session_id)
+                self.size += session.size
+            else:
+                self.sessions.move_to_end(session_id)
+            
+            history = session.history
+            if len(history) == history.maxlen:
+                dropped = history[0].size()
+                session.size -= dropped
+                self.size -= dropped
+            history.append(record)
+            session.size += record_size
+            self.size += record_size
+            session.last_seen = time.monotonic()
+            
+            self.evict()
+
+    def discard(self, session_id):
+        """Удаление сессии вместе с историей"""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self.size -= session.size
+
+    def evict(self):
+        """Вытеснение простаивающих и самых давних сессий (вызывается под lock)"""
+        deadline = time.monotonic() - self.idle_timeout
+        while len(self.sessions) > 1:
+            session_id, session = next(iter(self.sessions.items()))
+            if (session.last_seen >= deadline and len(self.sessions) <= self.max_sessions
+                    and self.size <= self.memory_limit):
+                break
+            del self.sessions[session_id]
+            self.size -= session.size
+            self.evicted += 1
+
+
+class ResponseCache:
+    """LRU-кэш базовых ответов (до применения шаблонов) с TTL на запись"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Значение по ключу или None, если его нет или срок истек"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def invalidate(self, predicate):
+        """Удаление записей, для ключа которых predicate(key) истинно"""
+        with self.lock:
+            stale = [key for key in self.entries if predicate(key)]
+            for key in stale:
+                del self.entries[key]
+            self.invalidated += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.invalidated += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """Счетчики кэша и доля попаданий"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'invalidated': self.invalidated
+        }
+
+
+class SingleFlightCall:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Схлопывание одинаковых одновременных вычислений
+
+    Первый запрос с ключом выполняет функцию, остальные пришедшие, пока она
+    работает, ждут и получают тот же результат. Если вычисление упало
+    (в том числе с BaseException), ожидающие получают свой RuntimeError,
+    сцепленный с исходной ошибкой: один объект исключения, поднятый в
+    нескольких потоках, копил бы трассировки всех потоков.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlightCall()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise RuntimeError(f"общее вычисление завершилось ошибкой: {call.error!r}") from call.error
+            return call.result
+        
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.calls)
+        }
+
+
+def format_labels(names, values):
+    """Метки Prometheus: {name="value",...}"""
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    """Счетчик Prometheus с метками"""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.values[labels] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        lines += [f"{self.name}{format_labels(self.labels, labels)} {value:g}" for labels, value in values]
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus: счетчики по корзинам, сумма и количество для каждого набора меток
+
+    Ряд меток хранится одним списком: счетчики корзин (последняя - +Inf),
+    а за ними сумма наблюдений.
+    """
+
+    def __init__(self, name, description, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def child(self, labels):
+        """Ряд для набора меток (создается при первом обращении; вызывающий держит lock)"""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        return series
+
+    def observe_locked(self, labels, value):
+        """Наблюдение без захвата lock (вызывающий уже держит его)"""
+        series = self.child(labels)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def observe(self, labels, value):
+        with self.lock:
+            self.observe_locked(labels, value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((labels, values[:-1], values[-1]) for labels, values in self.series.items())
+        names = self.labels + ('le',)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class BoundSeries(dict):
+    """Ряды гистограммы по значению одной метки при фиксированных остальных
+
+    Запись по готовому ряду обходится без кортежа меток и поиска по нему;
+    недостающий ряд создается под lock гистограммы.
+    """
+
+    def __init__(self, histogram, labels):
+        super().__init__()
+        self.histogram = histogram
+        self.labels = labels
+
+    def __missing__(self, value):
+        series = self[value] = self.histogram.child(self.labels(value))
+        return series
+
+
+class StageClock:
+    """Секундомер стадий одного запроса: отметки копятся и пишутся в метрики разом"""
+
+    __slots__ = ('started', 'marks')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.marks = []
+
+    def mark(self, stage):
+        """Завершение стадии (длительность считается при записи в метрики)"""
+        self.marks.append((stage, time.perf_counter()))
+
+
+class ChatMetrics:
+    """Метрики конвейера ответа в формате Prometheus
+
+    Стадии одного запроса записываются под одним захватом lock в ряды,
+    заранее привязанные к намерению (BoundSeries), без кортежей меток на
+    каждую стадию. Накладные расходы на запрос из семи стадий (StageClock
+    плюс record) - 4-7 мкс в зависимости от машины: больше, чем пара
+    микросекунд, но это десятые доли процента от ответа конвейера,
+    который занимает миллисекунды.
+    """
+
     def __init__(self):
+        self.stage_seconds = Histogram('futurechat_stage_seconds', 'Длительность стадии конвейера ответа',
+                                       ('stage', 'intent'))
+        self.request_seconds = Histogram('futurechat_request_seconds', 'Полное время ответа',
+                                         ('intent', 'source'))
+        self.source_seconds = Histogram('futurechat_source_seconds', 'Время ответа источника',
+                                        ('source',))
+        self.errors = Counter('futurechat_errors_total', 'Ошибки по месту возникновения', ('where',))
+        # Стадии и полное время пишутся вместе - общий lock на обе гистограммы
+        self.request_seconds.lock = self.stage_seconds.lock
+        # Намерение -> (ряды стадий, ряды полного времени по источникам)
+        self.bound = {}
+
+    def bind(self, intent):
+        """Ряды гистограмм для намерения (вызывающий держит lock)"""
+        bound = self.bound[intent] = (
+            BoundSeries(self.stage_seconds, lambda stage: (stage, intent)),
+            BoundSeries(self.request_seconds, lambda source: (intent, source))
+        )
+        return bound
+
+    def record(self, clock, intent, source):
+        # Тело Histogram.observe_locked развернуто: вызов на стадию заметен в бюджете
+        buckets = self.stage_seconds.buckets
+        previous = clock.started
+        with self.stage_seconds.lock:
+            stages, requests = self.bound.get(intent) or self.bind(intent)
+            for stage, moment in clock.marks:
+                series = stages[stage]
+                elapsed = moment - previous
+                series[bisect_left(buckets, elapsed)] += 1
+                series[-1] += elapsed
+                previous = moment
+            series = requests[source or 'нет ответа']
+            elapsed = previous - clock.started
+            series[bisect_left(self.request_seconds.buckets, elapsed)] += 1
+            series[-1] += elapsed
+
+    def render(self, extra=()):
+        """Текст для /metrics; extra - [(имя, тип, описание, [(метки, значение), ...])]"""
+        lines = []
+        for metric in (self.request_seconds, self.stage_seconds, self.source_seconds, self.errors):
+            lines += metric.render()
+        for name, kind, description, samples in extra:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            # Целые (байты, счетчики) - без округления %g до шести знаков
+            lines += [f"{name}{format_labels(tuple(labels), tuple(labels.values()))} "
+                      f"{value if isinstance(value, int) else format(value, 'g')}"
+                      for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+
+class WebAdvancedFutureChat:
+    # Таблицы ключевых слов анализаторов; компилируются в один автомат
+    INTENT_PATTERNS = {
+        'question': {
+            'patterns': ['что', 'как', 'где', 'когда', 'почему', 'зачем', 'кто', 'какой', 'какая', 'какое', 'сколько', 'можешь ли', 'умеешь ли', 'знаешь ли', 'объясни'],
+            'weight': 1.0
+        },
+        'story_request': {
+            'patterns': ['расскажи', 'рассказ', 'история', 'байка', 'сочини', 'придумай историю', 'напиши рассказ'],
+            'weight': 1.5
+        },
+        'creative_request': {
+            'patterns': ['создай', 'сочини', 'придумай', 'напиши', 'составь', 'сделай креативный'],
+            'weight': 1.3
+        },
+        'advice_request': {
+            'patterns': ['посоветуй', 'подскажи', 'рекомендуй', 'что делать', 'как быть', 'помоги решить', 'дай совет'],
+            'weight': 1.2
+        },
+        'explanation_request': {
+            'patterns': ['объясни', 'поясни', 'как работает', 'в чем суть', 'что означает', 'разъясни', 'что такое', 'как устроено', 'простыми словами'],
+            'weight': 1.1
+        },
+        'teaching': {
+            'patterns': ['научить:', 'запомни', 'выучи', 'знай что', 'это означает', 'это значит'],
+            'weight': 2.0
+        },
+        'casual': {
+            'patterns': ['привет', 'пока', 'как дела', 'спасибо', 'хорошо', 'плохо', 'отлично', 'круто'],
+            'weight': 0.8
+        },
+        'comparison': {
+            'patterns': ['разница', 'отличие', 'сравни', 'лучше', 'хуже', 'vs', 'против', 'или', 'чем отличается'],
+            'weight': 1.1
+        }
+    }
+    
+    USER_INTENT_PATTERNS = {
+        'question': [
+            'что', 'как', 'где', 'когда', 'почему', 'зачем', 'кто', 'какой', 'какая', 'какое',
+            'сколько', 'откуда', 'куда', 'чем', 'можешь ли', 'умеешь ли', 'знаешь ли'
+        ],
+        'request': [
+            'расскажи', 'объясни', 'покажи', 'помоги', 'сделай', 'найди', 'дай',
+            'подскажи', 'посоветуй', 'рекомендуй', 'предложи'
+        ],
+        'teaching': [
+            'научить:', 'запомни', 'выучи', 'знай что', 'это означает', 'это значит'
+        ],
+        'casual': [
+            'привет', 'пока', 'как дела', 'спасибо', 'хорошо', 'плохо', 'отлично',
+            'круто', 'интересно', 'понятно', 'ясно'
+        ],
+        'comparison': [
+            'разница', 'отличие', 'сравни', 'лучше', 'хуже', 'vs', 'против', 'или'
+        ]
+    }
+    
+    QUESTION_TYPE_PATTERNS = {
+        'definition': ['что такое', 'кто такой', 'определение', 'это'],
+        'how_to': ['как', 'каким образом', 'способ'],
+        'why': ['почему', 'зачем', 'по какой причине'],
+        'comparison': ['разница', 'отличие', 'сравни', 'vs', 'или']
+    }
+    
+    PROBLEM_TYPE_PATTERNS = {
+        'memory': ['забываю', 'память', 'помню', 'вспомнить'],
+        'learning': ['учиться', 'изучать', 'запомнить', 'выучить'],
+        'productivity': ['продуктивность', 'эффективность', 'время', 'успеть']
+    }
+    
+    CONVERSATION_TOPIC_KEYWORDS = {
+        "искусственный интеллект": ["ии", "ai", "искусственный", "интеллект", "нейросети", "машинное", "обучение"],
+        "программирование": ["python", "код", "программа", "алгоритм", "разработка", "программирование"],
+        "наука": ["физика", "химия", "биология", "математика", "исследование", "эксперимент"],
+        "технологии": ["компьютер", "интернет", "технология", "инновации", "цифровой"],
+        "космос": ["космос", "планета", "звезда", "вселенная", "галактика", "астрономия"],
+        "история": ["история", "древний", "прошлое", "цивилизация", "эпоха"],
+        "искусство": ["искусство", "музыка", "живопись", "культура", "творчество"],
+        "здоровье": ["здоровье", "медицина", "болезнь", "лечение", "врач"]
+    }
+    
+    RELATED_TOPIC_KEYWORDS = {
+        "искусственный интеллект": ["ии", "ai", "нейросети", "машинное", "алгоритм", "данные"],
+        "программирование": ["код", "python", "программа", "функция", "переменная"],
+        "наука": ["исследование", "теория", "эксперимент", "научный", "открытие"],
+        "технологии": ["технология", "компьютер", "цифровой", "инновация"],
+        "космос": ["планета", "звезда", "галактика", "вселенная", "астрономия"],
+        "история": ["исторический", "древний", "эпоха", "век", "прошлое"],
+        "искусство": ["художник", "музыка", "картина", "творческий", "культура"],
+        "здоровье": ["здоровый", "болезнь", "лечение", "медицинский", "организм"]
+    }
+    
+    CONTEXT_TRIGGERS = [
+        'продолжи', 'расскажи еще', 'а что насчет', 'объясни подробнее', 'дай пример',
+        'почему', 'как это работает', 'в чем разница', 'можешь ли', 'что если'
+    ]
+    
+    STORY_TOPICS = ['кот', 'собака', 'марс', 'космос', 'путешествие', 'дружба', 'любовь', 'приключения', 'детектив']
+    
+    EXPLANATION_TOPICS = ['машинное обучение', 'фотосинтез', 'искусственный интеллект', 'нейросети', 'программирование']
+    
+    TIME_KNOWLEDGE_PATTERNS = [
+        "время|сколько времени|который час",
+        "дата|какое число|сегодня|какой день"
+    ]
+    
+    def __init__(self, background_warmup=BACKGROUND_WARMUP, warm_state_path=WARM_STATE_PATH):
         self.name = "FutureChat Web Advanced"
         self.version = "4.0 NLP Enhanced"
         self.fallback_knowledge = {}
-        self.conversation_history = []
-        
-        # Инициализация NLP компонентов
-        self.initialize_nlp_components()
-        
-        # Инициализация ChatterBot
-        self.initialize_chatbot()
+        self.sessions = SessionStore()
+        self.chatbot = None
+        self.chatbot_available = False
+        self.learning_writer = None
+        self.storage_tuning = None
+        self.statement_maintenance = None
+        self.list_trainer = None
+        self.vectorizer = None
+        self.knowledge_base = []
+        self.semantic_index = None
+        self.arithmetic = SafeArithmetic()
+        self.exact_arithmetic = SafeArithmetic(number_type=Fraction)
+        
+        # Источники ответов опрашиваются параллельно; новый источник -
+        # это еще одна пара (имя, функция от ParsedInput -> (ответ, уверенность))
+        self.response_pool = ThreadPoolExecutor(max_workers=RESPONSE_WORKERS, thread_name_prefix='response-source')
+        self.response_sources = [
+            ('chatbot', self.get_chatbot_response),
+            ('fallback', self.get_fallback_response),
+            ('semantic', self.get_semantic_response),
+        ]
+        self.source_timeouts = defaultdict(int)
+        self.metrics = ChatMetrics()
+        self.response_cache = ResponseCache()
+        self.single_flight = SingleFlight()
+        
+        # Готовность компонентов: core собирается сразу, остальные - прогревом
+        self.components = {'core': 'warming', 'chatbot': 'warming', 'semantic': 'warming'}
+        self.ready = threading.Event()
+        self.started_at = time.time()
+        self.warmup_thread = None
+        
+        # Снимок производного состояния (python main.py build-snapshot) вместо пересчета
+        with startup_timer('phase', 'проверка снимка состояния'):
+            self.warm_sources = WarmStateSnapshot.sources()
+            self.warm_state = self.open_warm_state(warm_state_path)
+        
+        # Быстрое ядро: математика, время и база знаний по паттернам
+        with startup_timer('phase', 'NLP компоненты'):
+            self.initialize_nlp_components()
+        if self.warm_state:
+            with startup_timer('phase', 'ядро из снимка'):
+                self.restore_core_state()
+        else:
+            with startup_timer('phase', 'автомат ключевых слов'):
+                self.compile_keyword_automaton()
+            
+            # Загрузка дополнительных знаний
+            with startup_timer('phase', 'база знаний'):
+                self.load_fallback_knowledge()
+                self.init_fallback_knowledge()
+            
+            # Загрузка массивной энциклопедической базы
+            with startup_timer('phase', 'энциклопедия и индекс знаний'):
+                self.load_encyclopedia_knowledge()
+                self.build_fallback_index()
+            
+            if len(self.fallback_knowledge) != self.loaded_knowledge_topics:
+                # Файлы знаний переписаны при запуске - снимок должен ссылаться на новые
+                self.warm_sources = WarmStateSnapshot.sources()
+        self.components['core'] = 'ready'
+        
+        # ChatterBot и векторные индексы - в фоне, пока ядро уже отвечает
+        if background_warmup:
+            self.warmup_thread = threading.Thread(target=self.warm_up, name='warm-up', daemon=True)
+            self.warmup_thread.start()
+            print("🔥 Ядро готово, ChatterBot и семантический индекс прогреваются в фоне")
+        else:
+            self.warm_up()
+    
+    def warm_up(self):
+        """Прогрев тяжелых компонентов: ChatterBot, векторизатор, семантический индекс"""
+        try:
+            with startup_timer('phase', 'ChatterBot'):
+                self.initialize_chatbot()
+            self.components['chatbot'] = 'ready' if self.chatbot_available else 'failed'
+            
+            with startup_timer('phase', 'семантический индекс'):
+                self.initialize_vectorizer()
+                self.build_semantic_index()
+            self.components['semantic'] = 'ready' if self.semantic_index else ('failed' if self.vectorizer else 'disabled')
+        except Exception as e:
+            print(f"❌ Ошибка прогрева: {e}")
+            for name, state in self.components.items():
+                if state == 'warming':
+                    self.components[name] = 'failed'
+        finally:
+            STARTUP_TIMINGS.append(('total', 'от импорта main до конца прогрева', time.perf_counter() - PROCESS_STARTED))
+            self.ready.set()
+        print("✅ NLP система готова к работе!")
+        if STARTUP_PROFILE:
+            print_startup_profile()
+    
+    def wait_ready(self, timeout=None):
+        """Ожидание конца прогрева (для fork, бенчмарков и служебных команд)"""
+        return self.ready.wait(timeout)
+    
+    def readiness(self):
+        """Состояние компонентов для /readyz: ready, warming, failed или disabled"""
+        return {
+            'ready': self.ready.is_set(),
+            'uptime_s': round(time.time() - self.started_at, 3),
+            'components': dict(self.components)
+        }
+    
+    def open_warm_state(self, path):
+        """Снимок состояния, если он есть и собран из тех же исходников"""
+        if not path:
+            return None
+        snapshot = WarmStateSnapshot(path)
+        if not snapshot.open(self.warm_sources):
+            return None
+        print(f"🧊 Снимок состояния подключен: {path} (собран {snapshot.header['created']})")
+        return snapshot
+    
+    def restore_core_state(self):
+        """Ядро из снимка: база знаний с энциклопедией, автомат и индекс паттернов"""
+        objects = self.warm_state.objects
+        self.install_keyword_automaton(WarmStateSnapshot.restore_object(KeywordAutomaton, objects['keyword_automaton']))
+        
+        # Журнал пишет в тот же словарь, что и бот, как после KnowledgeJournal.load()
+        self.knowledge_journal = KnowledgeJournal()
+        self.knowledge_journal.knowledge = self.fallback_knowledge = objects['knowledge']
+        self.knowledge_journal.entries = objects['knowledge_entries']
+        self.loaded_knowledge_topics = objects['loaded_knowledge_topics']
+        self.knowledge_journal.start()
+        
+        self.fallback_index = WarmStateSnapshot.restore_object(FallbackKnowledgeIndex, objects['fallback_index'])
+        print(f"🗂️ База знаний из снимка: {len(self.fallback_knowledge)} тем, {len(self.fallback_index.variants)} вариантов")
+    
+    def save_warm_state(self, path=WARM_STATE_PATH):
+        """Запись снимка производного состояния (после прогрева, чтобы попали индексы)"""
+        objects = {
+            'knowledge': self.fallback_knowledge,
+            'knowledge_entries': self.knowledge_journal.entries,
+            'loaded_knowledge_topics': self.loaded_knowledge_topics,
+            'keyword_automaton': vars(self.keyword_automaton),
+            'fallback_index': vars(self.fallback_index)
+        }
+        arrays = {}
         
-        # Загрузка дополнительных знаний
-        self.load_fallback_knowledge()
-        self.init_fallback_knowledge()
+        if self.chatbot_available:
+            objects['indexed_search'], arrays['search.offsets'], arrays['search.ids'] = self.indexed_search.export_state()
         
-        # Загрузка массивной энциклопедической базы
-        self.load_encyclopedia_knowledge()
+        if self.semantic_index and self.semantic_index.counts is not None:
+            state = self.semantic_index.state()
+            arrays['semantic.df'] = state.pop('df')
+            for name in ('counts', 'matrix', 'matrix_t'):
+                state[name] = WarmStateSnapshot.put_matrix(arrays, f'semantic.{name}', state[name])
+            objects['semantic'] = state
         
-        print("✅ NLP система готова к работе!")
+        return WarmStateSnapshot(path).write(self.warm_sources, objects, arrays)
+    
+    def warm_semantic_state(self):
+        """Состояние семантического индекса из снимка (матрицы поверх mmap)"""
+        state = self.warm_state.objects.get('semantic') if self.warm_state else None
+        if state is None:
+            return None
+        state = dict(state, df=self.warm_state.ndarray('semantic.df'))
+        for name in ('counts', 'matrix', 'matrix_t'):
+            state[name] = self.warm_state.matrix(f'semantic.{name}', state[name])
+        return state
+    
+    def compile_keyword_automaton(self):
+        """Сборка всех таблиц ключевых слов в один автомат Ахо-Корасик"""
+        automaton = KeywordAutomaton()
+        automaton.add_table(
+            'intent',
+            {intent: data['patterns'] for intent, data in self.INTENT_PATTERNS.items()},
+            weights={intent: data['weight'] for intent, data in self.INTENT_PATTERNS.items()}
+        )
+        automaton.add_table('user_intent', self.USER_INTENT_PATTERNS)
+        automaton.add_table('emotion', getattr(self, 'emotion_markers', {}))
+        automaton.add_table('question_type', self.QUESTION_TYPE_PATTERNS)
+        automaton.add_table('problem_type', self.PROBLEM_TYPE_PATTERNS)
+        automaton.add_table('conversation_topic', self.CONVERSATION_TOPIC_KEYWORDS)
+        automaton.add_table('related_topic', self.RELATED_TOPIC_KEYWORDS)
+        automaton.add_table('context_trigger', {trigger: [trigger] for trigger in self.CONTEXT_TRIGGERS})
+        automaton.add_table('story_topic', {topic: [topic] for topic in self.STORY_TOPICS})
+        automaton.add_table('explanation_topic', {topic: [topic] for topic in self.EXPLANATION_TOPICS})
+        
+        self.install_keyword_automaton(automaton.compile())
+        print(f"🔤 Автомат ключевых слов: {len(automaton.entries)} слов, {len(automaton.goto)} состояний")
+    
+    def install_keyword_automaton(self, automaton):
+        self.keyword_automaton = automaton
+        # Анализаторы одного запроса сканируют один и тот же текст - считаем его один раз
+        self.scan_keywords = lru_cache(maxsize=1024)(lambda text: self.keyword_automaton.scan(text.lower()))
+    
+    def keyword_hits(self, text):
+        """Совпадения всех таблиц ключевых слов для текста (один проход)"""
+        if isinstance(text, ParsedInput):
+            if text.hits is None:
+                text.hits = self.keyword_automaton.scan(text.lower)
+            return text.hits
+        return self.scan_keywords(text)
+    
+    def stop_background_tasks(self):
+        """Остановка фоновых потоков со сбросом данных на диск (перед fork)"""
+        if self.learning_writer:
+            self.learning_writer.stop()
+        if self.statement_maintenance:
+            self.statement_maintenance.stop()
+        if self.storage_tuning:
+            self.storage_tuning.stop()
+        if self.semantic_index:
+            self.semantic_index.stop()
+        self.knowledge_journal.stop()
+        self.response_pool.shutdown(wait=True)
+    
+    def start_background_tasks(self, compact_journal=True):
+        """Запуск фоновых потоков в процессе-воркере после fork
+        
+        Потоки через fork не переживают, а соединения SQLite нельзя делить
+        между процессами - каждый воркер открывает свои. Несколько воркеров
+        дописывают общий журнал знаний, поэтому уплотнять его им нельзя;
+        обслуживание базы ChatterBot им тоже не поручаем (команда maintain).
+        """
+        if self.chatbot:
+            self.chatbot.storage.engine.dispose(close=False)
+        self.response_pool = ThreadPoolExecutor(max_workers=RESPONSE_WORKERS, thread_name_prefix='response-source')
+        if not compact_journal:
+            self.knowledge_journal.compact_entries = float('inf')
+        self.knowledge_journal.journal = None
+        self.knowledge_journal.start()
+        if self.semantic_index:
+            self.semantic_index.start()
+        if self.learning_writer:
+            self.learning_writer.start()
+        if self.storage_tuning:
+            self.storage_tuning.start()
+        if self.statement_maintenance and compact_journal:
+            self.statement_maintenance.start()
+    
+    def after_statement_maintenance(self, report):
+        """Индексы и кэш ссылаются на удаленные записи - пересобираем и сбрасываем их"""
+        self.indexed_search.rebuild()
+        print(f"🔎 Индекс поиска пересобран после обслуживания: {self.indexed_search.documents} записей")
+        if not report['retention_removed']:
+            # Дубликаты пар вопрос-ответ семантический индекс и так хранит по одной
+            return
+        if self.semantic_index:
+            documents = self.semantic_index.rebuild(self.get_semantic_documents())
+            self.knowledge_base = self.semantic_index.documents
+            print(f"🧭 Семантический индекс пересобран после обслуживания: {documents} документов")
+        self.response_cache.clear()
     
     def initialize_nlp_components(self):
         """Инициализация NLP компонентов для умного анализа текста"""
         try:
             print("🔧 Инициализация NLP компонентов...")
             
-            # Попытка загрузки NLTK данных
-            try:
-                nltk.download('punkt', quiet=True)
-                nltk.download('stopwords', quiet=True) 
-                nltk.download('wordnet', quiet=True)
-                print("📚 NLTK данные загружены!")
-            except:
-                print("⚠️ NLTK данные недоступны, используется базовая обработка")
-            
-            # Инициализация TF-IDF векторизатора если доступен sklearn
-            if SKLEARN_AVAILABLE:
-                self.vectorizer = TfidfVectorizer(
-                    max_features=1000,
-                    stop_words=None,  # Используем русские стоп-слова
-                    ngram_range=(1, 2),
-                    min_df=1,
-                    max_df=0.8
-                )
-                print("🧠 TF-IDF векторизатор готов!")
+            # Проверка данных NLTK на диске (загрузка - python -m nltk.downloader)
+            missing = missing_nltk_resources()
+            if not missing:
+                print("📚 NLTK данные найдены!")
             else:
-                self.vectorizer = None
-                
-            # База знаний для семантического поиска
-            self.knowledge_base = []
-            self.knowledge_vectors = None
+                print(f"⚠️ NLTK данные не найдены ({', '.join(missing)}), используется базовая обработка")
             
             # Словарь синонимов для лучшего понимания
             self.synonym_dict = {
@@ -103,27 +2643,72 @@ class WebAdvancedFutureChat:
             
         except Exception as e:
             print(f"⚠️ Ошибка инициализации NLP: {e}")
+    
+    def initialize_vectorizer(self):
+        """TF-IDF векторизатор, если доступен sklearn (импорт занимает больше секунды)
+        
+        Хэширующий векторизатор не требует обучения словаря, а IDF считает
+        SemanticIndex, поэтому документы добавляются по одному.
+        """
+        try:
+            if import_sklearn():
+                self.vectorizer = HashingVectorizer(
+                    n_features=SEMANTIC_HASH_FEATURES,
+                    ngram_range=(1, 2),
+                    stop_words=SEMANTIC_STOP_WORDS,
+                    alternate_sign=False,
+                    norm=None
+                )
+                print("🧠 TF-IDF векторизатор готов!")
+        except Exception as e:
+            print(f"⚠️ Ошибка инициализации векторизатора: {e}")
             self.vectorizer = None
         
     def initialize_chatbot(self):
         """Инициализация ChatterBot с настройками"""
         try:
             print("🧠 Инициализация ChatterBot...")
+            with startup_timer('import', 'chatterbot'):
+                from chatterbot import ChatBot
+            
+            # Без файла базы старый манифест ничего не значит
+            self.training_manifest = TrainingManifest()
+            if not os.path.exists(CHATBOT_DATABASE_PATH):
+                self.training_manifest.reset()
             
             # Упрощенная инициализация
             self.chatbot = ChatBot(
                 'FutureChat Advanced',
                 storage_adapter='chatterbot.storage.SQLStorageAdapter',
-                database_uri='sqlite:///web_advanced_chatbot.sqlite3',
+                database_uri=f'sqlite:///{CHATBOT_DATABASE_PATH}',
                 logic_adapters=[
                     'chatterbot.logic.BestMatch',
                     'chatterbot.logic.TimeLogicAdapter'
-                ]
+                ],
+                read_only=CHATBOT_READ_ONLY
             )
             
+            # PRAGMA, индексы и чекпоинты WAL - до обучения, чтобы оно шло уже по индексам
+            self.storage_tuning = SQLiteStorageTuning(self.chatbot.storage.engine)
+            self.storage_tuning.install()
+            self.storage_tuning.start()
+            
             print("🎓 Начало обучения...")
             # Обучение бота
             self.train_chatbot()
+            self.install_indexed_search()
+            
+            # Дубликаты, срок хранения выученного и VACUUM - по расписанию в фоне
+            self.statement_maintenance = StatementMaintenance(
+                self.chatbot.storage.engine, on_change=self.after_statement_maintenance
+            )
+            self.statement_maintenance.start()
+            
+            # В режиме только для чтения обучение идет через фоновую запись
+            if CHATBOT_READ_ONLY:
+                self.learning_writer = LearningWriter(self.chatbot)
+                self.learning_writer.start()
+                print(f"📝 Фоновая запись обучения: раз в {LEARNING_FLUSH_INTERVAL} с или по {LEARNING_BATCH_SIZE} записей")
             self.chatbot_available = True
             print("✅ ChatterBot готов к работе!")
             
@@ -131,107 +2716,172 @@ class WebAdvancedFutureChat:
             print(f"❌ Ошибка инициализации ChatterBot: {e}")
             print(f"Подробности ошибки: {str(e)}")
             self.chatbot = None
+            self.learning_writer = None
+            self.storage_tuning = None
+            self.statement_maintenance = None
             self.chatbot_available = False
     
-    def train_chatbot(self):
-        """Обучение ChatterBot"""
+    def install_indexed_search(self):
+        """Замена полного перебора BestMatch на поиск по инвертированному индексу"""
+        from chatterbot.search import IndexedTextSearch
+        
+        search = InvertedIndexSearch(self.chatbot)
+        state = self.warm_state.objects.get('indexed_search') if self.warm_state else None
+        restored = state is not None and search.restore_state(
+            state, self.warm_state.array('search.offsets'), self.warm_state.array('search.ids')
+        )
+        search.refresh()
+        
+        self.chatbot.search_algorithms[search.name] = search
+        for adapter in self.chatbot.logic_adapters:
+            if adapter.search_algorithm_name == IndexedTextSearch.name:
+                adapter.search_algorithm_name = search.name
+                adapter.search_algorithm = search
+        
+        self.indexed_search = search
+        print(f"🔎 Индекс поиска {'из снимка' if restored else 'готов'}: {search.documents} записей")
+    
+    def get_russian_conversations(self):
+        """Русскоязычные диалоги для обучения (пары вопрос-ответ)"""
+        return [
+            # Приветствие
+            "Привет", "Привет! Я продвинутый AI бот с машинным обучением! 🤖",
+            "Здравствуй", "Здравствуй! Как дела? Я готов к умному разговору! ✨",
+            "добро пожаловать", "Спасибо! Я рад быть здесь и общаться с тобой! 🎉",
+            
+            # Представление
+            "Как тебя зовут?", "Меня зовут FutureChat Advanced. Я умный AI бот с машинным обучением.",
+            "Кто ты?", "Я продвинутый AI чат-бот, использующий технологии машинного обучения для понимания и генерации ответов.",
+            "Представься", "Привет! Я FutureChat Advanced - умный AI бот, который учится на каждом разговоре.",
+            
+            # Возможности
+            "Что ты умеешь?", "Я могу умно беседовать, учиться на примерах, решать математику, определять время и запоминать информацию!",
+            "Твои функции?", "Машинное обучение, обработка естественного языка, математические вычисления, работа со временем и обучение на диалогах.",
+            "На что ты способен?", "Я использую алгоритмы машинного обучения для понимания контекста и генерации умных ответов!",
+            
+            # Как дела
+            "Как дела?", "У меня все отлично! Мои нейросети работают на полную мощность! 🧠",
+            "Как поживаешь?", "Прекрасно! Каждый разговор делает меня умнее!",
+            "Как жизнь?", "Жизнь AI бота интересная - постоянно учусь новому!",
+            
+            # Благодарности
+            "Спасибо", "Пожалуйста! Всегда рад помочь своими знаниями! 😊",
+            "Благодарю", "Не за что! Я здесь для того, чтобы быть полезным!",
+            
+            # Прощание
+            "Пока", "До свидания! Было приятно пообщаться! 👋",
+            "До встречи", "До встречи! Заходи еще - я буду еще умнее! 🚀",
+            "Всего доброго", "И тебе всего наилучшего! Хорошего дня! ✨",
+            
+            # AI и технологии
+            "Что такое искусственный интеллект?", "ИИ - это технология, позволяющая машинам имитировать человеческое мышление и обучаться на данных.",
+            "Как работает машинное обучение?", "Машинное обучение позволяет алгоритмам находить закономерности в данных и улучшать свои ответы с опытом.",
+            "Что такое нейросети?", "Нейронные сети - это вычислительные модели, вдохновленные структурой человеческого мозга.",
+            
+            # Обучение
+            "Как ты учишься?", "Я анализирую каждый диалог, запоминаю паттерны общения и улучшаю свои ответы на основе опыта.",
+            "Ты становишься умнее?", "Да! Каждый разговор добавляет новые знания в мою базу данных.",
+            
+            # Программирование
+            "Что такое Python?", "Python - мощный язык программирования, идеальный для AI, веб-разработки и анализа данных!",
+            "Расскажи про программирование", "Программирование - это искусство создания алгоритмов и решений с помощью кода!",
+            
+            # Помощь
+            "Помоги мне", "Конечно! Расскажи, с чем нужна помощь, и я сделаю все возможное!",
+            "Мне нужна помощь", "Я здесь, чтобы помочь! Опиши свою проблему подробнее.",
+        ]
+    
+    def get_training_sources(self):
+        """Источники обучения: имя, хэш содержимого и функция обучения"""
+        tagger = type(self.chatbot.tagger).__name__
+        sources = []
+        
+        russian_conversations = self.get_russian_conversations()
+        sources.append((
+            'russian_conversations',
+            TrainingManifest.digest({'tagger': tagger, 'data': russian_conversations}),
+            lambda: self.train_russian_conversations(russian_conversations)
+        ))
+        
+        try:
+            from chatterbot.corpus import list_corpus_files
+            for corpus in ("chatterbot.corpus.english.greetings", "chatterbot.corpus.english.conversations"):
+                content = hashlib.sha256(tagger.encode('utf-8'))
+                for file_path in list_corpus_files(corpus):
+                    with open(file_path, 'rb') as f:
+                        content.update(f.read())
+                sources.append((
+                    corpus,
+                    content.hexdigest(),
+                    lambda corpus=corpus: self.train_corpus(corpus)
+                ))
+        except Exception as e:
+            print(f"⚠️ Английский корпус недоступен: {e}")
+        
+        return sources
+    
+    def train_chatbot(self, force=False):
+        """Обучение ChatterBot только на новых или измененных источниках"""
         try:
-            # Тренеры
             if not self.chatbot:
                 return
-            list_trainer = ListTrainer(self.chatbot)
-            
-            # Русскоязычные диалоги
-            russian_conversations = [
-                # Приветствие
-                "Привет", "Привет! Я продвинутый AI бот с машинным обучением! 🤖",
-                "Здравствуй", "Здравствуй! Как дела? Я готов к умному разговору! ✨",
-                "добро пожаловать", "Спасибо! Я рад быть здесь и общаться с тобой! 🎉",
-                
-                # Представление
-                "Как тебя зовут?", "Меня зовут FutureChat Advanced. Я умный AI бот с машинным обучением.",
-                "Кто ты?", "Я продвинутый AI чат-бот, использующий технологии машинного обучения для понимания и генерации ответов.",
-                "Представься", "Привет! Я FutureChat Advanced - умный AI бот, который учится на каждом разговоре.",
-                
-                # Возможности
-                "Что ты умеешь?", "Я могу умно беседовать, учиться на примерах, решать математику, определять время и запоминать информацию!",
-                "Твои функции?", "Машинное обучение, обработка естественного языка, математические вычисления, работа со временем и обучение на диалогах.",
-                "На что ты способен?", "Я использую алгоритмы машинного обучения для понимания контекста и генерации умных ответов!",
-                
-                # Как дела
-                "Как дела?", "У меня все отлично! Мои нейросети работают на полную мощность! 🧠",
-                "Как поживаешь?", "Прекрасно! Каждый разговор делает меня умнее!",
-                "Как жизнь?", "Жизнь AI бота интересная - постоянно учусь новому!",
-                
-                # Благодарности
-                "Спасибо", "Пожалуйста! Всегда рад помочь своими знаниями! 😊",
-                "Благодарю", "Не за что! Я здесь для того, чтобы быть полезным!",
-                
-                # Прощание
-                "Пока", "До свидания! Было приятно пообщаться! 👋",
-                "До встречи", "До встречи! Заходи еще - я буду еще умнее! 🚀",
-                "Всего доброго", "И тебе всего наилучшего! Хорошего дня! ✨",
-                
-                # AI и технологии
-                "Что такое искусственный интеллект?", "ИИ - это технология, позволяющая машинам имитировать человеческое мышление и обучаться на данных.",
-                "Как работает машинное обучение?", "Машинное обучение позволяет алгоритмам находить закономерности в данных и улучшать свои ответы с опытом.",
-                "Что такое нейросети?", "Нейронные сети - это вычислительные модели, вдохновленные структурой человеческого мозга.",
-                
-                # Обучение
-                "Как ты учишься?", "Я анализирую каждый диалог, запоминаю паттерны общения и улучшаю свои ответы на основе опыта.",
-                "Ты становишься умнее?", "Да! Каждый разговор добавляет новые знания в мою базу данных.",
+            
+            trained = 0
+            for source, digest, train in self.get_training_sources():
+                if not force and self.training_manifest.is_current(source, digest):
+                    continue
                 
-                # Программирование
-                "Что такое Python?", "Python - мощный язык программирования, идеальный для AI, веб-разработки и анализа данных!",
-                "Расскажи про программирование", "Программирование - это искусство создания алгоритмов и решений с помощью кода!",
+                try:
+                    train()
+                except Exception as e:
+                    print(f"⚠️ Источник {source} не обучен: {e}")
+                    continue
                 
-                # Помощь
-                "Помоги мне", "Конечно! Расскажи, с чем нужна помощь, и я сделаю все возможное!",
-                "Мне нужна помощь", "Я здесь, чтобы помочь! Опиши свою проблему подробнее.",
-            ]
-            
-            # Обучение по парам
-            for i in range(0, len(russian_conversations), 2):
-                if i + 1 < len(russian_conversations):
-                    list_trainer.train([
-                        russian_conversations[i],
-                        russian_conversations[i + 1]
-                    ])
+                self.training_manifest.mark_trained(source, digest)
+                trained += 1
             
-            print("✅ Обучение русскому языку завершено!")
-            
-            # Попытка обучения на английском корпусе
-            try:
-                if not self.chatbot:
-                    return
-                corpus_trainer = ChatterBotCorpusTrainer(self.chatbot)
-                print("📚 Дополнительное обучение на английском корпусе...")
-                corpus_trainer.train("chatterbot.corpus.english.greetings")
-                corpus_trainer.train("chatterbot.corpus.english.conversations")
-                print("✅ Английское обучение завершено!")
-            except Exception as e:
-                print(f"⚠️ Английский корпус недоступен: {e}")
+            if not trained:
+                print("⚡ База ChatterBot актуальна, обучение не требуется!")
                 
         except Exception as e:
             print(f"❌ Ошибка при обучении: {e}")
     
+    def train_russian_conversations(self, russian_conversations):
+        """Обучение на русскоязычных диалогах"""
+        from chatterbot.trainers import ListTrainer
+        
+        list_trainer = ListTrainer(self.chatbot)
+        
+        # Обучение по парам
+        for i in range(0, len(russian_conversations), 2):
+            if i + 1 < len(russian_conversations):
+                list_trainer.train([
+                    russian_conversations[i],
+                    russian_conversations[i + 1]
+                ])
+        
+        print("✅ Обучение русскому языку завершено!")
+    
+    def train_corpus(self, corpus):
+        """Дополнительное обучение на английском корпусе"""
+        from chatterbot.trainers import ChatterBotCorpusTrainer
+        
+        corpus_trainer = ChatterBotCorpusTrainer(self.chatbot)
+        print(f"📚 Дополнительное обучение на корпусе {corpus}...")
+        corpus_trainer.train(corpus)
+        print("✅ Английское обучение завершено!")
+    
     def load_fallback_knowledge(self):
-        """Загрузка дополнительной базы знаний"""
-        try:
-            if os.path.exists('web_advanced_knowledge.json'):
-                with open('web_advanced_knowledge.json', 'r', encoding='utf-8') as f:
-                    self.fallback_knowledge = json.load(f)
-            else:
-                self.fallback_knowledge = {}
-        except Exception as e:
-            print(f"Ошибка загрузки знаний: {e}")
-            self.fallback_knowledge = {}
+        """Загрузка дополнительной базы знаний (снимок + журнал обучения)"""
+        self.knowledge_journal = KnowledgeJournal()
+        self.fallback_knowledge = self.knowledge_journal.load()
+        self.loaded_knowledge_topics = len(self.fallback_knowledge)
+        self.knowledge_journal.start()
     
     def save_fallback_knowledge(self):
-        """Сохранение дополнительной базы знаний"""
+        """Сохранение дополнительной базы знаний (полный снимок)"""
         try:
-            with open('web_advanced_knowledge.json', 'w', encoding='utf-8') as f:
-                json.dump(self.fallback_knowledge, f, ensure_ascii=False, indent=2)
+            self.knowledge_journal.compact()
         except Exception as e:
             print(f"Ошибка сохранения знаний: {e}")
     
@@ -263,11 +2913,21 @@ class WebAdvancedFutureChat:
         try:
             if not self.chatbot:
                 return None, 0
-            response = self.chatbot.get_response(user_input)
+            
+            user_input = ParsedInput.of(user_input).text
+            if self.learning_writer:
+                # Предыдущий ответ берем из памяти, чтобы не сканировать базу
+                conversation = self.chatbot.default_conversation
+                previous = self.learning_writer.last_response(conversation)
+                response = self.chatbot.get_response(user_input, in_response_to=previous or '')
+                self.learning_writer.learn(user_input, response)
+            else:
+                response = self.chatbot.get_response(user_input)
             confidence = response.confidence
             return str(response), confidence
         except Exception as e:
             print(f"Ошибка ChatterBot: {e}")
+            self.metrics.errors.inc(('chatbot',))
             return None, 0
     
     def get_fallback_response(self, user_input):
@@ -280,20 +2940,89 @@ class WebAdvancedFutureChat:
         # Обновляем время
         self.update_time_responses()
         
-        normalized_input = re.sub(r'[^\w\s]', '', user_input.lower()).strip()
-        
-        for pattern, responses in self.fallback_knowledge.items():
-            variants = [v.strip().lower() for v in pattern.split('|')]
-            
-            for variant in variants:
-                if variant in normalized_input or normalized_input in variant:
-                    return random.choice(responses), 0.9
+        parsed = ParsedInput.of(user_input)
+        pattern = self.fallback_index.lookup(parsed.normalized, parsed.grams)
+        if pattern is not None:
+            return random.choice(self.fallback_knowledge[pattern]), 0.9
         
         return None, 0
     
+    def build_fallback_index(self):
+        """Построение индекса паттернов базы знаний"""
+        self.fallback_index = FallbackKnowledgeIndex(self.fallback_knowledge)
+        print(f"🗂️ Индекс базы знаний: {len(self.fallback_index.keys)} тем, {len(self.fallback_index.variants)} вариантов")
+    
+    @staticmethod
+    def knowledge_document(key):
+        """Документ семантического индекса для темы базы знаний"""
+        return " ".join(variant.strip() for variant in key.split('|')), ('knowledge', key)
+    
+    def get_semantic_documents(self):
+        """Документы для TF-IDF: темы базы знаний и пары вопрос-ответ ChatterBot"""
+        documents = [self.knowledge_document(key) for key in self.fallback_knowledge]
+        
+        if self.chatbot:
+            storage = self.chatbot.storage
+            Statement = storage.get_model('statement')
+            session = storage.Session()
+            try:
+                rows = session.query(
+                    Statement.in_response_to, Statement.text
+                ).filter(
+                    Statement.in_response_to.isnot(None), ~Statement.persona.startswith('bot:')
+                ).distinct().order_by(Statement.in_response_to, Statement.text).all()
+            finally:
+                session.close()
+            documents.extend((question, ('chatterbot', answer)) for question, answer in rows)
+        
+        return documents
+    
+    def build_semantic_index(self):
+        """Обучение TF-IDF векторизатора (или загрузка сохраненной матрицы)"""
+        self.semantic_index = None
+        if not self.vectorizer:
+            return
+        
+        try:
+            index = SemanticIndex(self.vectorizer)
+            rebuilt = index.build(self.get_semantic_documents(), self.warm_semantic_state())
+            index.start()
+            self.knowledge_base = index.documents
+            self.semantic_index = index
+            state = "собран" if rebuilt else f"загружен с диска (+{index.pending_rows()} новых)"
+            print(f"🧭 Семантический индекс {state}: {len(index.documents)} документов")
+        except Exception as e:
+            print(f"⚠️ Семантический индекс недоступен: {e}")
+    
+    def get_semantic_response(self, user_input):
+        """Ответ ближайшего по TF-IDF документа и его косинусная близость"""
+        if not self.semantic_index:
+            return None, 0
+        
+        parsed = ParsedInput.of(user_input)
+        if parsed.semantic is None:
+            # Результаты остаются на разборе: по ним потом выбирается TTL кэша
+            parsed.semantic = self.semantic_index.search(parsed.lower)
+        hit = self.semantic_hit(parsed.semantic)
+        if hit is None:
+            return None, 0
+        score, source, payload = hit
+        if source == 'knowledge':
+            return random.choice(self.fallback_knowledge[payload]), score
+        return payload, score
+    
+    def semantic_hit(self, results):
+        """Документ, которым отвечает семантический поиск: (оценка, источник, тема или ответ)"""
+        for score, (source, payload) in results:
+            if score < SEMANTIC_MIN_SCORE:
+                break
+            if source != 'knowledge' or self.fallback_knowledge.get(payload):
+                return score, source, payload
+        return None
+    
     def solve_math_expression(self, user_input):
         """Решение математических выражений как в ChatGPT"""
-        import re
+        parsed = ParsedInput.of(user_input)
         
         # Паттерны для математических выражений
         math_patterns = [
@@ -306,9 +3035,9 @@ class WebAdvancedFutureChat:
         
         expression = None
         for pattern in math_patterns:
-            match = re.search(pattern, user_input, re.IGNORECASE)
+            match = re.search(pattern, parsed.text, re.IGNORECASE)
             if match:
-                expression = match.group(1) if len(match.groups()) == 1 else user_input
+                expression = match.group(1) if len(match.groups()) == 1 else parsed.text
                 break
         
         if not expression:
@@ -334,8 +3063,11 @@ class WebAdvancedFutureChat:
             if not expression:
                 return None
             
-            # Безопасное вычисление
-            result = eval(expression)
+            # Безопасное вычисление с лимитами; "точно" - ответ обыкновенной дробью
+            if 'точно' in parsed.lower:
+                result = self.exact_arithmetic.evaluate(expression)
+            else:
+                result = self.arithmetic.evaluate(expression)
             
             # Форматируем ответ как в ChatGPT
             responses = [
@@ -352,12 +3084,7 @@ class WebAdvancedFutureChat:
     
     def update_time_responses(self):
         """Обновление временных ответов"""
-        time_patterns = [
-            "время|сколько времени|который час",
-            "дата|какое число|сегодня|какой день"
-        ]
-        
-        for pattern in time_patterns:
+        for pattern in self.TIME_KNOWLEDGE_PATTERNS:
             if pattern in self.fallback_knowledge:
                 if "время" in pattern:
                     self.fallback_knowledge[pattern] = [
@@ -370,76 +3097,300 @@ class WebAdvancedFutureChat:
                         f"Дата: {datetime.now().strftime('%d %B %Y')} 🗓️"
                     ]
     
-    def generate_smart_response(self, user_input):
-        """🧠 Генерация умного ответа с использованием продвинутой NLP системы"""
+    def generate_smart_response(self, user_input, session_id=DEFAULT_SESSION):
+        """🧠 Генерация умного ответа с использованием продвинутой NLP системы"""
+        return self.respond(user_input, session_id)[0]
+    
+    def respond(self, user_input, session_id=DEFAULT_SESSION):
+        """Ответ вместе с источником и уровнем уверенности: (ответ, источник, уверенность)"""
+        clock = StageClock()
+        try:
+            response, source, confidence, intent = self.run_pipeline(user_input, session_id, clock)
+        except Exception:
+            self.metrics.errors.inc(('pipeline',))
+            raise
+        clock.mark('history')
+        self.metrics.record(clock, intent, source)
+        return response, source, confidence
+    
+    def run_pipeline(self, user_input, session_id, clock):
+        """Стадии ответа с отметками времени: (ответ, источник, уверенность, намерение)"""
+        
+        # 0. Разбираем ввод один раз - все анализаторы работают с этим объектом
+        parsed = ParsedInput.of(user_input)
+        user_input = parsed.text
+        clock.mark('parse')
         
         # 1. Продвинутый анализ намерений с эмоциями
-        intent, emotion = self.enhanced_intent_analysis(user_input)
+        intent, emotion = self.enhanced_intent_analysis(parsed)
+        clock.mark('intent')
         
         # 2. Специальная обработка для разных типов запросов
         if intent == 'story_request':
-            response = self.generate_story_response(user_input)
-            return self.save_to_history(user_input, response, f"Генератор историй ({emotion})")
+            response = self.generate_story_response(parsed)
+            clock.mark('generator')
+            return self.save_to_history(session_id, user_input, response, f"Генератор историй ({emotion})"), "Генератор историй", 'high', intent
         
         if intent == 'explanation_request':
-            topic = self.extract_explanation_topic(user_input)
-            response = self.generate_explanation_response(user_input, topic)
-            return self.save_to_history(user_input, response, f"Система объяснений ({emotion})")
+            topic = self.extract_explanation_topic(parsed)
+            response = self.generate_explanation_response(parsed, topic)
+            clock.mark('generator')
+            return self.save_to_history(session_id, user_input, response, f"Система объяснений ({emotion})"), "Система объяснений", 'high', intent
         
         if intent == 'advice_request':
-            response = self.generate_advice_response(user_input)
-            return self.save_to_history(user_input, response, f"Система советов ({emotion})")
+            response = self.generate_advice_response(parsed)
+            clock.mark('generator')
+            return self.save_to_history(session_id, user_input, response, f"Система советов ({emotion})"), "Система советов", 'high', intent
         
         if intent == 'creative_request':
-            response = self.generate_creative_response(user_input)
-            return self.save_to_history(user_input, response, f"Творческая система ({emotion})")
+            response = self.generate_creative_response(parsed)
+            clock.mark('generator')
+            return self.save_to_history(session_id, user_input, response, f"Творческая система ({emotion})"), "Творческая система", 'high', intent
             
         # 3. Для вопросов типа "объясни" - не используем контекст, а идем прямо к объяснению
-        if 'объясни' in user_input.lower() or 'что такое' in user_input.lower():
-            topic = self.extract_explanation_topic(user_input)
-            response = self.generate_explanation_response(user_input, topic)
-            return self.save_to_history(user_input, response, f"Система объяснений (принудительно)")
+        if 'объясни' in parsed.lower or 'что такое' in parsed.lower:
+            topic = self.extract_explanation_topic(parsed)
+            response = self.generate_explanation_response(parsed, topic)
+            clock.mark('generator')
+            return self.save_to_history(session_id, user_input, response, f"Система объяснений (принудительно)"), "Система объяснений", 'high', intent
             
         # 4. Анализируем контекст последних сообщений (только для других запросов)
-        context_response = self.analyze_conversation_context(user_input)
+        context_response = self.analyze_conversation_context(parsed, session_id)
+        clock.mark('context')
         if context_response:
             enhanced_context = self.apply_chatgpt_response_templates(
-                context_response, user_input, intent, 'high', emotion
+                context_response, parsed, intent, 'high', emotion
             )
-            return self.save_to_history(user_input, enhanced_context, f"Контекстный анализ ({intent}, {emotion})")
-        
-        # 5. Получаем ответы от разных источников
-        chatbot_response, chatbot_confidence = self.get_chatbot_response(user_input)
-        fallback_response, fallback_confidence = self.get_fallback_response(user_input)
+            clock.mark('templates')
+            return self.save_to_history(session_id, user_input, enhanced_context, f"Контекстный анализ ({intent}, {emotion})"), "Контекстный анализ", 'high', intent
+        
+        # 5. Повторяющиеся запросы берем из кэша базовых ответов, шаблоны
+        # ниже все равно применяются заново и разнообразят формулировку.
+        # Одинаковые запросы, пришедшие одновременно, ждут одно вычисление
+        cache_key = (parsed.key, intent)
+        cached = self.response_cache.get(cache_key)
+        clock.mark('cache')
+        timed_out = []
+        if cached is not None:
+            response, source, confidence_level = cached
+        else:
+            response, source, confidence_level, timed_out = self.single_flight.do(
+                cache_key, lambda: self.compute_base_response(parsed, intent, cache_key)
+            )
+            clock.mark('sources')
         
-        # 6. Определяем уровень уверенности
-        confidence_level = self.determine_confidence_level(chatbot_confidence, fallback_confidence, intent)
+        # 6. Применяем продвинутые шаблоны ChatGPT с учетом эмоций
+        if response:
+            response = self.apply_chatgpt_response_templates(
+                response, parsed, intent, confidence_level, emotion
+            )
+        clock.mark('templates')
+        
+        # 7. Сохраняем в историю с полными метаданными
+        metadata = f"Intent: {intent}, Emotion: {emotion}, Confidence: {confidence_level}"
+        if timed_out:
+            metadata += f", Timeout: {', '.join(timed_out)}"
+        if cached is not None:
+            metadata += ", Cache: hit"
+        return self.save_to_history(session_id, user_input, response, f"{source} ({metadata})"), source, confidence_level, intent
+    
+    @staticmethod
+    def is_command(user_message):
+        """Команда обучения "научить: тема - информация"?"""
+        return user_message.lower().strip().startswith('научить:')
+    
+    def answer_command(self, user_message):
+        """Ответ на команду обучения (None - сообщение не команда)"""
+        if not self.is_command(user_message):
+            return None
+        try:
+            content = user_message.split(':', 1)[1].strip()
+            if ' - ' in content:
+                topic, info = content.split(' - ', 1)
+                topic = topic.strip()
+                info = info.strip()
+                return self.add_knowledge(topic, info)
+            return "Используй формат: научить: тема - информация 📚"
+        except:
+            return "Ошибка в команде обучения. Формат: научить: тема - информация 📚"
+    
+    def generate_batch_responses(self, messages, session_id=None):
+        """Ответы на пачку сообщений с общей подготовкой
+        
+        Каждое сообщение разбирается один раз (повторы - один объект),
+        семантический поиск для всех выполняется одним умножением матриц,
+        а выученные ChatterBot диалоги записываются одной транзакцией после
+        пачки. Без session_id каждое сообщение отвечается в отдельной
+        временной сессии, чтобы ответы не зависели от порядка. Команды
+        "научить:" выполняются как в чате; ошибка одного сообщения дает
+        запись с 'error' на его месте, а не сбой всей пачки.
+        Возвращает [{'response', 'source', 'confidence'}] в порядке входа.
+        """
+        parsed_inputs = {}
+        for message in messages:
+            if message.strip() and message not in parsed_inputs and not self.is_command(message):
+                parsed_inputs[message] = ParsedInput(message)
+        
+        if self.semantic_index and parsed_inputs:
+            unique = list(parsed_inputs.values())
+            for parsed, results in zip(unique, self.semantic_index.search_many([parsed.lower for parsed in unique])):
+                parsed.semantic = results
+        
+        results = []
+        batch_id = secrets.token_urlsafe(8)
+        with self.learning_writer.hold() if self.learning_writer else nullcontext():
+            for position, message in enumerate(messages):
+                if not message.strip():
+                    results.append({'response': 'Напиши что-нибудь! 😊', 'source': None, 'confidence': None})
+                    continue
+                if message not in parsed_inputs:
+                    results.append({'response': self.answer_command(message), 'source': 'Команда обучения',
+                                    'confidence': None})
+                    continue
+                item_session = session_id or f"batch:{batch_id}:{position}"
+                try:
+                    response, source, confidence = self.respond(parsed_inputs[message], item_session)
+                except Exception as e:
+                    print(f"Ошибка пакетной обработки (сообщение {position}): {e}")
+                    results.append({'response': 'Произошла ошибка в нейросети! Попробуй еще раз. 🤖',
+                                    'source': None, 'confidence': None, 'error': True})
+                    continue
+                finally:
+                    if not session_id:
+                        self.sessions.discard(item_session)
+                results.append({'response': response, 'source': source, 'confidence': confidence})
+        return results
+    
+    def compute_base_response(self, parsed, intent, cache_key):
+        """Базовый ответ из всех источников (до шаблонов) с записью в кэш"""
+        # Пока идет прогрев, ChatterBot и семантический поиск молчат, и
+        # select_best_response отвечает из базы знаний и генераторов
+        warmed_up = self.ready.is_set()
+        
+        # Получаем ответы от разных источников (параллельно, с дедлайном)
+        answers, timed_out = self.gather_responses(parsed)
+        chatbot_response, chatbot_confidence = answers['chatbot']
+        fallback_response, fallback_confidence = answers['fallback']
+        semantic_response, semantic_confidence = answers['semantic']
+        
+        # Определяем уровень уверенности
+        confidence_level = self.determine_confidence_level(
+            chatbot_confidence, max(fallback_confidence, semantic_confidence), intent
+        )
         
-        # 7. Выбираем лучший ответ на основе намерения и уверенности
+        # Выбираем лучший ответ на основе намерения и уверенности
         response, source = self.select_best_response(
             chatbot_response, chatbot_confidence,
             fallback_response, fallback_confidence,
-            intent, user_input
+            intent, parsed,
+            semantic_response, semantic_confidence
         )
         
-        # 8. Применяем продвинутые шаблоны ChatGPT с учетом эмоций
-        if response:
-            response = self.apply_chatgpt_response_templates(
-                response, user_input, intent, confidence_level, emotion
-            )
+        # Ответ при опоздавших источниках или во время прогрева неполный - его не кэшируем
+        if not warmed_up:
+            source += " (прогрев)"
+        elif response and not timed_out:
+            self.response_cache.put(cache_key, (response, source, confidence_level),
+                                    ttl=self.response_cache_ttl(parsed, source))
+        
+        return response, source, confidence_level, timed_out
+    
+    def response_cache_ttl(self, parsed, source):
+        """TTL записи кэша: ответы о времени и дате быстро устаревают"""
+        if self.response_topic(parsed, source) in self.TIME_KNOWLEDGE_PATTERNS:
+            return RESPONSE_CACHE_TIME_TTL
+        return None
+    
+    def response_topic(self, parsed, source):
+        """Тема базы знаний, из которой взят выбранный ответ (None - не из базы знаний)"""
+        if source == "База знаний":
+            return self.fallback_index.lookup(parsed.normalized, parsed.grams)
+        if source == "Семантический поиск" and parsed.semantic:
+            hit = self.semantic_hit(parsed.semantic)
+            if hit is not None and hit[1] == 'knowledge':
+                return hit[2]
+        return None
+    
+    def invalidate_cached_responses(self, topic):
+        """Сброс кэшированных ответов, на которые могло повлиять новое знание"""
+        variants = [variant.strip() for variant in topic.lower().split('|') if variant.strip()]
+        tokens = set(re.findall(r'\w+', topic.lower()))
+        
+        def affected(key):
+            normalized = key[0]
+            return (any(variant in normalized or normalized in variant for variant in variants) or
+                    not tokens.isdisjoint(normalized.split()))
+        
+        return self.response_cache.invalidate(affected)
+    
+    def gather_responses(self, parsed, deadline=RESPONSE_DEADLINE):
+        """Опрос всех источников ответов в пуле потоков с общим дедлайном
+        
+        Возвращает ответы по именам источников и список тех, кто не успел:
+        их ответ считается пустым, а сами вызовы дорабатывают в фоне.
+        """
+        futures = {self.response_pool.submit(self.timed_source, name, source, parsed): name
+                   for name, source in self.response_sources}
+        done, _ = wait(futures, timeout=deadline)
+        
+        answers = {}
+        timed_out = []
+        for future, name in futures.items():
+            if future in done:
+                try:
+                    answers[name] = future.result()
+                except Exception as e:
+                    print(f"⚠️ Источник {name} завершился ошибкой: {e}")
+                    self.metrics.errors.inc((f'source_{name}',))
+                    answers[name] = (None, 0)
+            else:
+                future.cancel()
+                timed_out.append(name)
+                self.source_timeouts[name] += 1
+                answers[name] = (None, 0)
         
-        # 9. Сохраняем в историю с полными метаданными
-        return self.save_to_history(user_input, response, f"{source} (Intent: {intent}, Emotion: {emotion}, Confidence: {confidence_level})")
+        return answers, timed_out
+    
+    def timed_source(self, name, source, parsed):
+        """Вызов источника ответа с записью его времени в метрики"""
+        start = time.perf_counter()
+        try:
+            return source(parsed)
+        finally:
+            self.metrics.source_seconds.observe((name,), time.perf_counter() - start)
+    
+    def render_metrics(self):
+        """Метрики в текстовом формате Prometheus: конвейер плюс состояние кэша и источников"""
+        cache = self.response_cache.stats()
+        flights = self.single_flight.stats()
+        extra = [
+            ('futurechat_chatbot_available', 'gauge', 'ChatterBot доступен (1) или нет (0)',
+             [({}, 1 if self.chatbot_available else 0)]),
+            ('futurechat_component_ready', 'gauge', 'Компонент прогрет (1) или нет (0)',
+             [({'component': name}, 1 if state == 'ready' else 0) for name, state in sorted(self.components.items())]),
+            ('futurechat_response_cache_hits_total', 'counter', 'Попадания в кэш базовых ответов', [({}, cache['hits'])]),
+            ('futurechat_response_cache_misses_total', 'counter', 'Промахи кэша базовых ответов', [({}, cache['misses'])]),
+            ('futurechat_response_cache_entries', 'gauge', 'Записей в кэше базовых ответов', [({}, cache['entries'])]),
+            ('futurechat_single_flight_coalesced_total', 'counter', 'Запросы, дождавшиеся чужого вычисления',
+             [({}, flights['coalesced'])]),
+            ('futurechat_source_timeouts_total', 'counter', 'Источники, не успевшие к дедлайну',
+             [({'source': name}, count) for name, count in sorted(self.source_timeouts.items())]),
+            ('futurechat_sessions', 'gauge', 'Активные сессии разговоров', [({}, len(self.sessions))]),
+            ('futurechat_process_peak_rss_bytes', 'gauge', 'Пиковый RSS процесса',
+             [({}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)]),
+        ]
+        if self.storage_tuning:
+            extra += [
+                ('futurechat_sqlite_wal_bytes', 'gauge', 'Размер файла WAL базы ChatterBot',
+                 [({}, self.storage_tuning.wal_size())]),
+                ('futurechat_sqlite_checkpoints_total', 'counter', 'Чекпоинты WAL по результату',
+                 [({'result': result}, count) for result, count in sorted(self.storage_tuning.checkpoints.items())]),
+            ]
+        return self.metrics.render(extra)
     
     def extract_explanation_topic(self, user_input):
         """Извлечение темы для объяснения"""
-        topics = ['машинное обучение', 'фотосинтез', 'искусственный интеллект', 'нейросети', 'программирование']
-        user_lower = user_input.lower()
-        
-        for topic in topics:
-            if topic in user_lower:
-                return topic
-        return "общая тема"
+        return self.keyword_hits(user_input).first('explanation_topic', "общая тема")
     
     def generate_advice_response(self, user_input):
         """Генерация советов и рекомендаций"""
@@ -490,16 +3441,7 @@ class WebAdvancedFutureChat:
     
     def analyze_problem_type(self, user_input):
         """Определение типа проблемы для персонализированных советов"""
-        user_lower = user_input.lower()
-        
-        if any(word in user_lower for word in ['забываю', 'память', 'помню', 'вспомнить']):
-            return 'memory'
-        elif any(word in user_lower for word in ['учиться', 'изучать', 'запомнить', 'выучить']):
-            return 'learning'  
-        elif any(word in user_lower for word in ['продуктивность', 'эффективность', 'время', 'успеть']):
-            return 'productivity'
-        else:
-            return 'general'
+        return self.keyword_hits(user_input).first('problem_type', 'general')
     
     def generate_creative_response(self, user_input):
         """Генерация креативных ответов"""
@@ -512,14 +3454,22 @@ class WebAdvancedFutureChat:
         return f"{random.choice(creative_templates)}\n\n🎨 К сожалению, моя креативная система еще развивается, но я могу помочь с идеями и направлениями! Можешь описать подробнее, что именно хотел бы создать?\n\n💡 Я лучше всего справляюсь с текстовыми задачами, объяснениями и советами!"
     
     def select_best_response(self, chatbot_response, chatbot_confidence, 
-                           fallback_response, fallback_confidence, intent, user_input):
+                           fallback_response, fallback_confidence, intent, user_input,
+                           semantic_response=None, semantic_confidence=0):
         """Выбор лучшего ответа в зависимости от намерения"""
         
+        # Кандидат семантического поиска занимает место ответа базы знаний,
+        # если точного совпадения по паттернам нет или оно слабее
+        fallback_source = "База знаний"
+        if semantic_response and semantic_confidence > fallback_confidence:
+            fallback_response, fallback_confidence = semantic_response, semantic_confidence
+            fallback_source = "Семантический поиск"
+        
         # Стратегии ответов для разных намерений
         if intent == 'teaching':
             # Для обучения приоритет базе знаний
             if fallback_confidence >= 0.6:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             elif chatbot_confidence >= 0.4:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             else:
@@ -530,11 +3480,11 @@ class WebAdvancedFutureChat:
             if chatbot_confidence >= 0.7:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             elif fallback_confidence >= 0.8:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             elif chatbot_confidence >= 0.5:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             elif fallback_confidence > 0:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             else:
                 return self.generate_contextual_unknown_response(user_input), "AI Система"
         
@@ -543,14 +3493,14 @@ class WebAdvancedFutureChat:
             if chatbot_confidence >= 0.5:
                 return chatbot_response, "ChatterBot"
             elif fallback_confidence > 0:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             else:
                 return self.generate_casual_response(user_input), "Casual система"
         
         elif intent == 'request':
             # Для просьб стараемся быть максимально полезными
             if fallback_confidence >= 0.7:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             elif chatbot_confidence >= 0.6:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             else:
@@ -561,11 +3511,11 @@ class WebAdvancedFutureChat:
             if chatbot_confidence >= 0.7:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             elif fallback_confidence >= 0.8:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             elif chatbot_confidence >= 0.4:
                 return self.enhance_response(chatbot_response, user_input), "ChatterBot Enhanced"
             elif fallback_confidence > 0:
-                return fallback_response, "База знаний"
+                return fallback_response, fallback_source
             else:
                 return self.generate_contextual_unknown_response(user_input), "AI Система"
     
@@ -598,70 +3548,23 @@ class WebAdvancedFutureChat:
         ]
         return random.choice(responses)
     
-    def save_to_history(self, user_input, response, source):
-        """Сохранение в историю"""
-        self.conversation_history.append({
-            'user': user_input,
-            'bot': response,
-            'source': source,
-            'timestamp': datetime.now().isoformat()
-        })
-        
-        # Ограничиваем историю
-        if len(self.conversation_history) > 100:
-            self.conversation_history = self.conversation_history[-100:]
-        
+    def save_to_history(self, session_id, user_input, response, source):
+        """Сохранение в историю сессии"""
+        self.sessions.append(session_id, user_input, response, source)
         return response
     
     def analyze_user_intent(self, user_input):
         """Анализ намерений пользователя"""
-        user_lower = user_input.lower().strip()
-        
-        # Классификация намерений
-        intent_patterns = {
-            'question': [
-                'что', 'как', 'где', 'когда', 'почему', 'зачем', 'кто', 'какой', 'какая', 'какое',
-                'сколько', 'откуда', 'куда', 'чем', 'можешь ли', 'умеешь ли', 'знаешь ли'
-            ],
-            'request': [
-                'расскажи', 'объясни', 'покажи', 'помоги', 'сделай', 'найди', 'дай',
-                'подскажи', 'посоветуй', 'рекомендуй', 'предложи'
-            ],
-            'teaching': [
-                'научить:', 'запомни', 'выучи', 'знай что', 'это означает', 'это значит'
-            ],
-            'casual': [
-                'привет', 'пока', 'как дела', 'спасибо', 'хорошо', 'плохо', 'отлично',
-                'круто', 'интересно', 'понятно', 'ясно'
-            ],
-            'comparison': [
-                'разница', 'отличие', 'сравни', 'лучше', 'хуже', 'vs', 'против', 'или'
-            ]
-        }
-        
-        # Подсчитываем совпадения для каждого намерения
-        intent_scores = {}
-        for intent, patterns in intent_patterns.items():
-            score = 0
-            for pattern in patterns:
-                if pattern in user_lower:
-                    score += 1
-            intent_scores[intent] = score
-        
-        # Определяем главное намерение
-        if max(intent_scores.values()) == 0:
-            return 'unknown'
-        
-        return max(intent_scores.items(), key=lambda x: x[1])[0]
+        # Подсчитываем совпадения для каждого намерения за один проход автомата
+        return self.keyword_hits(user_input).best('user_intent', 'unknown')
     
-    def analyze_conversation_context(self, user_input):
+    def analyze_conversation_context(self, user_input, session_id=DEFAULT_SESSION):
         """Продвинутый анализ контекста разговора"""
-        if len(self.conversation_history) < 1:
+        # Анализируем последние 10 сообщений этой сессии для контекста
+        recent_messages = self.sessions.recent(session_id, 10)
+        if not recent_messages:
             return None
-        
-        # Анализируем последние 10 сообщений для контекста
-        recent_messages = self.conversation_history[-10:]
-        user_input_lower = user_input.lower()
+        parsed = ParsedInput.of(user_input)
         
         # Определяем основную тему разговора
         conversation_topic = self.extract_conversation_topic(recent_messages)
@@ -681,17 +3584,17 @@ class WebAdvancedFutureChat:
         }
         
         # Проверяем контекстные триггеры
-        for trigger, response_start in context_triggers.items():
-            if trigger in user_input_lower:
-                return f"{response_start} {self.generate_contextual_continuation(conversation_topic, user_input)}"
+        trigger = self.keyword_hits(parsed).first('context_trigger')
+        if trigger:
+            return f"{context_triggers[trigger]} {self.generate_contextual_continuation(conversation_topic, user_input)}"
         
         # Анализ ссылок на предыдущие сообщения
         reference_words = ['это', 'этого', 'того', 'такое', 'такой', 'оно', 'он', 'она', 'они']
-        if any(word in user_input_lower.split() for word in reference_words):
+        if any(word in parsed.token_set for word in reference_words):
             return self.handle_reference_question(user_input, recent_messages, conversation_topic)
         
         # Проверка на продолжение темы
-        if conversation_topic and self.is_related_to_topic(user_input, conversation_topic):
+        if conversation_topic and self.is_related_to_topic(parsed, conversation_topic):
             return self.generate_topic_continuation(user_input, conversation_topic)
         
         return None
@@ -702,50 +3605,14 @@ class WebAdvancedFutureChat:
             return "общение"
         
         # Ключевые слова из последних сообщений
-        all_text = " ".join([msg['user'] + " " + msg['bot'] for msg in recent_messages[-5:]])
-        
-        # Словарь тем и их ключевых слов
-        topic_keywords = {
-            "искусственный интеллект": ["ии", "ai", "искусственный", "интеллект", "нейросети", "машинное", "обучение"],
-            "программирование": ["python", "код", "программа", "алгоритм", "разработка", "программирование"],
-            "наука": ["физика", "химия", "биология", "математика", "исследование", "эксперимент"],
-            "технологии": ["компьютер", "интернет", "технология", "инновации", "цифровой"],
-            "космос": ["космос", "планета", "звезда", "вселенная", "галактика", "астрономия"],
-            "история": ["история", "древний", "прошлое", "цивилизация", "эпоха"],
-            "искусство": ["искусство", "музыка", "живопись", "культура", "творчество"],
-            "здоровье": ["здоровье", "медицина", "болезнь", "лечение", "врач"]
-        }
+        all_text = " ".join([msg.user + " " + msg.bot for msg in recent_messages[-5:]])
         
         # Подсчитываем упоминания тем
-        topic_scores = {}
-        for topic, keywords in topic_keywords.items():
-            score = sum(1 for keyword in keywords if keyword in all_text.lower())
-            if score > 0:
-                topic_scores[topic] = score
-        
-        if topic_scores:
-            return max(topic_scores.items(), key=lambda x: x[1])[0]
-        
-        return "общение"
+        return self.keyword_hits(all_text).best('conversation_topic', "общение")
     
     def is_related_to_topic(self, user_input, topic):
         """Проверка связи вопроса с текущей темой"""
-        topic_keywords = {
-            "искусственный интеллект": ["ии", "ai", "нейросети", "машинное", "алгоритм", "данные"],
-            "программирование": ["код", "python", "программа", "функция", "переменная"],
-            "наука": ["исследование", "теория", "эксперимент", "научный", "открытие"],
-            "технологии": ["технология", "компьютер", "цифровой", "инновация"],
-            "космос": ["планета", "звезда", "галактика", "вселенная", "астрономия"],
-            "история": ["исторический", "древний", "эпоха", "век", "прошлое"],
-            "искусство": ["художник", "музыка", "картина", "творческий", "культура"],
-            "здоровье": ["здоровый", "болезнь", "лечение", "медицинский", "организм"]
-        }
-        
-        if topic in topic_keywords:
-            keywords = topic_keywords[topic]
-            return any(keyword in user_input.lower() for keyword in keywords)
-        
-        return False
+        return self.keyword_hits(user_input).score('related_topic', topic) > 0
     
     def generate_topic_continuation(self, user_input, topic):
         """Генерация продолжения темы"""
@@ -787,7 +3654,7 @@ class WebAdvancedFutureChat:
         if not recent_messages:
             return None
         
-        last_topic = recent_messages[-1]['user'] if recent_messages else ""
+        last_topic = recent_messages[-1].user if recent_messages else ""
         responses = [
             f"Понимаю твою мысль! Если говорить про то, что мы обсуждали касательно '{last_topic}', то могу пояснить! 🤔",
             f"Отличный вопрос! Возвращаясь к нашему разговору про '{last_topic}' - это действительно интересная тема! 💭",
@@ -798,69 +3665,19 @@ class WebAdvancedFutureChat:
     
     def enhanced_intent_analysis(self, user_input):
         """Продвинутый анализ намерений с использованием NLP"""
-        user_lower = user_input.lower().strip()
+        # Один проход автомата дает и эмоцию, и взвешенные баллы намерений
+        hits = self.keyword_hits(user_input)
         
         # Определяем эмоциональный тон
-        emotion = self.detect_emotion(user_lower)
-        
-        # Расширенная классификация намерений с весами
-        intent_patterns = {
-            'question': {
-                'patterns': ['что', 'как', 'где', 'когда', 'почему', 'зачем', 'кто', 'какой', 'какая', 'какое', 'сколько', 'можешь ли', 'умеешь ли', 'знаешь ли', 'объясни'],
-                'weight': 1.0
-            },
-            'story_request': {
-                'patterns': ['расскажи', 'рассказ', 'история', 'байка', 'сочини', 'придумай историю', 'напиши рассказ'],
-                'weight': 1.5
-            },
-            'creative_request': {
-                'patterns': ['создай', 'сочини', 'придумай', 'напиши', 'составь', 'сделай креативный'],
-                'weight': 1.3
-            },
-            'advice_request': {
-                'patterns': ['посоветуй', 'подскажи', 'рекомендуй', 'что делать', 'как быть', 'помоги решить', 'дай совет'],
-                'weight': 1.2
-            },
-            'explanation_request': {
-                'patterns': ['объясни', 'поясни', 'как работает', 'в чем суть', 'что означает', 'разъясни', 'что такое', 'как устроено', 'простыми словами'],
-                'weight': 1.1
-            },
-            'teaching': {
-                'patterns': ['научить:', 'запомни', 'выучи', 'знай что', 'это означает', 'это значит'],
-                'weight': 2.0
-            },
-            'casual': {
-                'patterns': ['привет', 'пока', 'как дела', 'спасибо', 'хорошо', 'плохо', 'отлично', 'круто'],
-                'weight': 0.8
-            },
-            'comparison': {
-                'patterns': ['разница', 'отличие', 'сравни', 'лучше', 'хуже', 'vs', 'против', 'или', 'чем отличается'],
-                'weight': 1.1
-            }
-        }
-        
-        # Подсчитываем взвешенные совпадения
-        intent_scores = {}
-        for intent, data in intent_patterns.items():
-            score = 0
-            for pattern in data['patterns']:
-                if pattern in user_lower:
-                    score += data['weight']
-            intent_scores[intent] = score
+        emotion = hits.first('emotion', 'neutral')
         
         # Определяем главное намерение
-        if max(intent_scores.values()) == 0:
-            return 'unknown', emotion
-        
-        main_intent = max(intent_scores.items(), key=lambda x: x[1])[0]
+        main_intent = hits.best('intent', 'unknown')
         return main_intent, emotion
     
     def detect_emotion(self, text):
         """Определение эмоционального тона сообщения"""
-        for emotion, markers in self.emotion_markers.items():
-            if any(marker in text for marker in markers):
-                return emotion
-        return 'neutral'
+        return self.keyword_hits(text).first('emotion', 'neutral')
     
     def generate_story_response(self, user_input):
         """Генерация историй и рассказов"""
@@ -905,17 +3722,8 @@ class WebAdvancedFutureChat:
     
     def extract_story_topic(self, user_input):
         """Извлечение темы для истории из запроса пользователя"""
-        user_lower = user_input.lower()
-        
-        # Ищем ключевые слова
-        topics = ['кот', 'собака', 'марс', 'космос', 'путешествие', 'дружба', 'любовь', 'приключения', 'детектив']
-        
-        for topic in topics:
-            if topic in user_lower:
-                return topic
-                
         # Если ничего не найдено, возвращаем общую тему
-        return "удивительные приключения"
+        return self.keyword_hits(user_input).first('story_topic', "удивительные приключения")
     
     def generate_explanation_response(self, user_input, topic):
         """Генерация подробных объяснений"""
@@ -988,7 +3796,7 @@ class WebAdvancedFutureChat:
         
         # Ищем подходящее объяснение
         for key, explanation in explanations.items():
-            if key in user_input.lower():
+            if key in ParsedInput.of(user_input).lower:
                 return f"{starter}\n\n{explanation}\n\n❓ Остались вопросы? Спрашивай!"
         
         # Если точного объяснения нет, генерируем общий ответ
@@ -1141,22 +3949,12 @@ class WebAdvancedFutureChat:
     
     def analyze_question_type(self, user_input):
         """Анализ типа вопроса"""
-        user_lower = user_input.lower()
-        
-        if any(word in user_lower for word in ['что такое', 'кто такой', 'определение', 'это']):
-            return "definition"
-        elif any(word in user_lower for word in ['как', 'каким образом', 'способ']):
-            return "how_to"
-        elif any(word in user_lower for word in ['почему', 'зачем', 'по какой причине']):
-            return "why"
-        elif any(word in user_lower for word in ['разница', 'отличие', 'сравни', 'vs', 'или']):
-            return "comparison"
-        else:
-            return "general"
+        return self.keyword_hits(user_input).first('question_type', "general")
     
     def generate_contextual_unknown_response(self, user_input):
         """Умные ответы на неизвестные темы как в ChatGPT"""
         question_type = self.analyze_question_type(user_input)
+        user_input = str(user_input)
         
         if question_type == "definition":
             responses = [
@@ -1184,6 +3982,7 @@ class WebAdvancedFutureChat:
     
     def generate_unknown_response(self, user_input):
         """Генерация ответа для неизвестной темы"""
+        user_input = str(user_input)
         unknown_responses = [
             f"Интересный вопрос про '{user_input}'! Я изучу эту тему и стану умнее 🤓",
             f"Про '{user_input}' я еще недостаточно знаю. Расскажи мне больше! 📚",
@@ -1199,17 +3998,30 @@ class WebAdvancedFutureChat:
         
         if topic_key not in self.fallback_knowledge:
             self.fallback_knowledge[topic_key] = []
+            self.fallback_index.add(topic_key)
+            if self.semantic_index:
+                self.semantic_index.add(*self.knowledge_document(topic_key))
         
         self.fallback_knowledge[topic_key].append(info)
-        self.save_fallback_knowledge()
+        try:
+            self.knowledge_journal.append(topic_key, info)
+        except Exception as e:
+            print(f"Ошибка сохранения знаний: {e}")
         
         # Также обучаем ChatterBot если доступен
-        if self.chatbot_available and self.chatbot:
+        if self.chatbot_available and self.learning_writer:
+            self.learning_writer.add_conversation([topic, info])
+        elif self.chatbot_available and self.chatbot:
             try:
-                trainer = ListTrainer(self.chatbot)
-                trainer.train([topic, info])
+                if self.list_trainer is None:
+                    from chatterbot.trainers import ListTrainer
+                    self.list_trainer = ListTrainer(self.chatbot)
+                self.list_trainer.train([topic, info])
             except Exception as e:
                 print(f"Ошибка обучения ChatterBot: {e}")
+        if self.chatbot_available and self.semantic_index:
+            self.semantic_index.add(topic, ('chatterbot', info))
+        self.invalidate_cached_responses(topic_key)
         
         thanks_responses = [
             f"Отлично! Теперь я знаю про {topic} благодаря машинному обучению! 🧠",
@@ -1287,11 +4099,14 @@ class WebAdvancedFutureChat:
             if topic not in self.fallback_knowledge:
                 self.fallback_knowledge[topic] = responses
         
-        self.save_fallback_knowledge()
+        # Снимок пишем только если при старте добавились новые темы
+        if len(self.fallback_knowledge) != self.loaded_knowledge_topics:
+            self.save_fallback_knowledge()
         print("📚 Энциклопедическая база знаний загружена!")
 
 # Создаем экземпляр бота
 bot = WebAdvancedFutureChat()
+STARTUP_TIMINGS.append(('total', 'от импорта main до ответов ядра', time.perf_counter() - PROCESS_STARTED))
 
 # HTML шаблон (улучшенный дизайн)
 HTML_TEMPLATE = """
@@ -1640,29 +4455,33 @@ HTML_TEMPLATE = """
         const sendButton = document.getElementById('sendButton');
         const typingIndicator = document.getElementById('typingIndicator');
 
-        function typeMessage(content, messageDiv) {
-            const messageContent = messageDiv.querySelector('.message-content');
-            let i = 0;
-            messageContent.innerHTML = '';
-            
-            const typingSpeed = 30; // миллисекунды на символ
-            
-            function typeNextChar() {
-                if (i < content.length) {
-                    messageContent.innerHTML += content.charAt(i);
-                    i++;
-                    setTimeout(typeNextChar, typingSpeed);
-                    scrollToBottom();
-                } else {
-                    // Завершение типизации
-                    scrollToBottom();
-                }
+        // Части ответа копятся в буфере и выводятся раз в кадр отрисовки
+        function createMessageStream(messageContent) {
+            let pending = '';
+            let scheduled = false;
+
+            function flush() {
+                scheduled = false;
+                const fragment = document.createDocumentFragment();
+                pending.split('\\n').forEach((line, index) => {
+                    if (index > 0) fragment.appendChild(document.createElement('br'));
+                    if (line) fragment.appendChild(document.createTextNode(line));
+                });
+                pending = '';
+                messageContent.appendChild(fragment);
+                scrollToBottom();
             }
-            
-            typeNextChar();
+
+            return function push(text) {
+                pending += text;
+                if (!scheduled) {
+                    scheduled = true;
+                    requestAnimationFrame(flush);
+                }
+            };
         }
 
-        function addMessage(content, isUser = false, shouldType = false) {
+        function addMessage(content, isUser = false) {
             const messageDiv = document.createElement('div');
             messageDiv.className = `message ${isUser ? 'user' : 'bot'}`;
             
@@ -1683,14 +4502,10 @@ HTML_TEMPLATE = """
                 messageDiv.appendChild(avatar);
                 messageDiv.appendChild(messageContent);
                 chatMessages.appendChild(messageDiv);
-                
-                if (shouldType && content.length > 20) {
-                    typeMessage(content.replace(/\\n/g, '<br>'), messageDiv);
-                } else {
-                    messageContent.innerHTML = content.replace(/\\n/g, '<br>');
-                    scrollToBottom();
-                }
+                messageContent.innerHTML = content.replace(/\\n/g, '<br>');
+                scrollToBottom();
             }
+            return messageContent;
         }
 
         function scrollToBottom() {
@@ -1716,24 +4531,46 @@ HTML_TEMPLATE = """
             showTyping();
 
             try {
-                const response = await fetch('/chat', {
+                const response = await fetch('/chat/stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
                     body: JSON.stringify({ message: message })
                 });
+                if (!response.ok || !response.body) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
 
-                const data = await response.json();
-                
-                // Имитация времени обработки нейросетью
-                const processingTime = 800 + (data.response.length * 20);
-                setTimeout(() => {
+                // Разбираем кадры Server-Sent Events по мере прихода
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let push = null;
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) >= 0) {
+                        const frame = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        const data = frame.split('\\n').find(line => line.startsWith('data: '));
+                        const payload = data ? JSON.parse(data.slice(6)) : {};
+                        if (payload.text) {
+                            if (!push) {
+                                hideTyping();
+                                push = createMessageStream(addMessage('', false));
+                            }
+                            push(payload.text);
+                        }
+                    }
+                }
+                if (!push) {
                     hideTyping();
-                    addMessage(data.response, false, true); // Включаем типизацию
-                    sendButton.disabled = false;
-                    messageInput.focus();
-                }, processingTime);
+                }
+                sendButton.disabled = false;
+                messageInput.focus();
 
             } catch (error) {
                 hideTyping();
@@ -1766,6 +4603,34 @@ def index():
     """Главная страница"""
     return render_template_string(HTML_TEMPLATE)
 
+def get_session_id(data=None):
+    """Идентификатор сессии из запроса (поле session_id или cookie) или новый"""
+    session_id = (data or {}).get('session_id') or request.cookies.get(SESSION_COOKIE)
+    if isinstance(session_id, str) and 0 < len(session_id) <= 64:
+        return session_id
+    return secrets.token_urlsafe(16)
+
+def with_session_cookie(response, session_id):
+    """Установка cookie сессии, если клиент ее еще не прислал"""
+    if request.cookies.get(SESSION_COOKIE) != session_id:
+        response.set_cookie(SESSION_COOKIE, session_id, max_age=int(SESSION_IDLE_TIMEOUT),
+                            httponly=True, samesite='Lax')
+    return response
+
+def answer_message(user_message, session_id):
+    """Ответ на сообщение чата: команда обучения или умный ответ; (ответ, источник)"""
+    if not isinstance(user_message, str) or not user_message.strip():
+        return 'Напиши что-нибудь! 😊', None
+    
+    # Проверяем команду обучения
+    command_response = bot.answer_command(user_message)
+    if command_response is not None:
+        return command_response, 'Команда обучения'
+    
+    # Генерируем умный ответ
+    response, source, _ = bot.respond(user_message, session_id)
+    return response, source
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """API для чата"""
@@ -1773,41 +4638,1068 @@ def chat():
         data = request.json
         if not data:
             return jsonify({'response': 'Неверные данные! 😕'})
+        session_id = get_session_id(data)
         user_message = data.get('message', '')
         
-        if not user_message.strip():
-            return jsonify({'response': 'Напиши что-нибудь! 😊'})
-        
-        # Проверяем команду обучения
-        if user_message.lower().strip().startswith('научить:'):
-            try:
-                content = user_message.split(':', 1)[1].strip()
-                if ' - ' in content:
-                    topic, info = content.split(' - ', 1)
-                    topic = topic.strip()
-                    info = info.strip()
-                    response = bot.add_knowledge(topic, info)
-                else:
-                    response = "Используй формат: научить: тема - информация 📚"
-            except:
-                response = "Ошибка в команде обучения. Формат: научить: тема - информация 📚"
-        else:
-            # Генерируем умный ответ
-            response = bot.generate_smart_response(user_message)
-        
-        return jsonify({'response': response})
+        response, source = answer_message(user_message, session_id)
+        return with_session_cookie(jsonify({'response': response, 'source': source}), session_id)
         
     except Exception as e:
         print(f"Ошибка в чате: {e}")
+        bot.metrics.errors.inc(('chat',))
         return jsonify({'response': 'Произошла ошибка в нейросети! Попробуй еще раз. 🤖'})
 
-if __name__ == '__main__':
+@app.route('/healthz')
+def healthz():
+    """Живость процесса: отвечает, пока процесс обслуживает запросы"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Готовность: 200 после прогрева, 503 пока компоненты прогреваются"""
+    state = bot.readiness()
+    return jsonify(state), 200 if state['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus"""
+    return Response(bot.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def batch_answers(data):
+    """Пакетный ответ: {"messages": [...], "session_id"?} -> (тело ответа, HTTP-статус)"""
+    messages = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(messages, list) or not all(isinstance(message, str) for message in messages):
+        return {'error': 'Ожидается {"messages": ["...", ...]}'}, 400
+    if len(messages) > BATCH_MAX_MESSAGES:
+        return {'error': f'Не больше {BATCH_MAX_MESSAGES} сообщений за запрос'}, 413
+    
+    session_id = data.get('session_id')
+    if not (isinstance(session_id, str) and 0 < len(session_id) <= 64):
+        session_id = None
+    try:
+        return {'results': bot.generate_batch_responses(messages, session_id)}, 200
+    except Exception as e:
+        print(f"Ошибка пакетной обработки: {e}")
+        return {'error': 'Произошла ошибка в нейросети! Попробуй еще раз. 🤖'}, 500
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Пакетный API чата для оценки и массовых клиентов"""
+    payload, status = batch_answers(request.get_json(silent=True))
+    return jsonify(payload), status
+
+def response_chunks(text):
+    """Ответ по частям для потоковой отдачи: предложения и строки"""
+    return [chunk for chunk in re.findall(r'[^.!?\n]*[.!?\n]*\s*', text) if chunk]
+
+def sse_event(payload, event=None):
+    """Кадр Server-Sent Events с JSON-данными"""
+    frame = f"event: {event}\n" if event else ''
+    return frame + f"data: {json.dumps(payload)}\n\n"
+
+def streamed_answer(user_message, session_id):
+    """Ответ для потока: ошибка конвейера становится текстом ответа"""
+    try:
+        return answer_message(user_message, session_id)[0]
+    except Exception as e:
+        print(f"Ошибка в чате: {e}")
+        bot.metrics.errors.inc(('chat',))
+        return 'Произошла ошибка в нейросети! Попробуй еще раз. 🤖'
+
+def answer_events(response):
+    """Кадры SSE готового ответа: текст частями и done"""
+    for chunk in response_chunks(response):
+        yield sse_event({'text': chunk})
+    yield sse_event({}, 'done')
+
+def stream_answer(user_message, session_id):
+    """Поток SSE: кадр start сразу, текст - частями, когда конвейер соберет ответ
+
+    Конвейер строит ответ целиком (шаблоны применяются ко всему тексту),
+    поэтому раньше остальных приходит только start; текстовые кадры
+    избавляют клиент от искусственных задержек и перерисовки по символу.
+    """
+    yield sse_event({'session_id': session_id}, 'start')
+    yield from answer_events(streamed_answer(user_message, session_id))
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Потоковый API чата (text/event-stream)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
+        return jsonify({'response': 'Неверные данные! 😕'}), 400
+    session_id = get_session_id(data)
+    response = Response(stream_with_context(stream_answer(data.get('message', ''), session_id)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return with_session_cookie(response, session_id)
+
+def benchmark_search(sizes, queries=200, baseline_limit=100000, seed=42):
+    """Замер задержки поиска ChatterBot в зависимости от размера таблицы"""
+    from chatterbot import ChatBot
+    from chatterbot.search import IndexedTextSearch
+    from chatterbot.conversation import Statement
+    from chatterbot.tagging import LowercaseTagger
+    
+    rng = random.Random(seed)
+    vocabulary = [word.lower() for word in re.findall(r'\w+', " ".join(bot.get_russian_conversations()))]
+    vocabulary += [f"слово{i}" for i in range(20000)]
+    
+    def make_text():
+        return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 8)))
+    
+    results = []
+    for size in sizes:
+        chatbot = ChatBot(
+            'FutureChat Benchmark',
+            database_uri=None,
+            tagger=LowercaseTagger,
+            read_only=True
+        )
+        
+        # Быстрое заполнение таблицы напрямую через SQL
+        rows = []
+        for _ in range(size):
+            question, answer = make_text(), make_text()
+            rows.append((answer, answer, question, question, 'benchmark', ''))
+        with chatbot.storage.engine.begin() as connection:
+            connection.exec_driver_sql(
+                'INSERT INTO statement (text, search_text, in_response_to, search_in_response_to, conversation, persona) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+        
+        probes = [Statement(text=rng.choice(rows)[2], search_text='') for _ in range(queries)]
+        for probe in probes:
+            probe.search_text = probe.text.lower()
+        
+        build_start = time.perf_counter()
+        indexed = InvertedIndexSearch(chatbot)
+        indexed.refresh()
+        build_time = time.perf_counter() - build_start
+        
+        row = {'size': size, 'index_build_s': round(build_time, 3)}
+        searches = [('inverted_index', indexed)]
+        if size <= baseline_limit:
+            searches.append(('full_scan', IndexedTextSearch(chatbot)))
+        
+        for label, search in searches:
+            latencies = []
+            for probe in probes:
+                start = time.perf_counter()
+                list(search.search(probe))
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            row[f'{label}_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 3)
+            row[f'{label}_p95_ms'] = round(latencies[int(len(latencies) * 0.95)] * 1000, 3)
+        
+        print(f"📊 {row}")
+        results.append(row)
+    
+    return results
+
+def print_maintenance_report(report):
+    """Отчет обслуживания базы: удаленные строки, размер файла и задержки запросов"""
+    mode = " (пробный прогон, без изменений)" if report['dry_run'] else ""
+    print(f"🧹 Обслуживание базы ChatterBot{mode} за {report['seconds']} с:")
+    print(f"   записей: {report['rows_before']} -> {report['rows_after']} "
+          f"(дубликатов {report['duplicates_removed']}, устаревших {report['retention_removed']})")
+    if 'vacuum' in report:
+        print(f"   VACUUM ({report['vacuum']}): освобождено страниц {report['pages_freed']}")
+    print(f"   размер базы с WAL: {report['size_bytes_before'] / 1024:.0f} КБ -> {report['size_bytes_after'] / 1024:.0f} КБ")
+    for name, before in report.get('latency_before', {}).items():
+        after = report.get('latency_after', {}).get(name)
+        if after:
+            print(f"   {name:<22} p50 {before['p50_ms']:>9.3f} мс -> {after['p50_ms']:>9.3f} мс")
+
+def time_statement_queries(connection, probes):
+    """Задержки запросов SQLITE_PROBE_QUERIES с параметрами из записей-образцов"""
+    cursor = connection.cursor()
+    results = {}
+    for name, sql, fields in SQLITE_PROBE_QUERIES:
+        cursor.execute(sql, tuple(probes[0][field] for field in fields)).fetchall()
+        latencies = []
+        for probe in probes:
+            start = time.perf_counter()
+            cursor.execute(sql, tuple(probe[field] for field in fields)).fetchall()
+            latencies.append(time.perf_counter() - start)
+        results[name] = latency_summary(latencies)
+    cursor.close()
+    return results
+
+def benchmark_sqlite(rows=100000, queries=200, seed=42):
+    """Замер запросов ChatterBot к копии базы: как есть и после SQLiteStorageTuning
+
+    Обе копии получают одинаковые данные (база плюс синтетические диалоги до
+    rows записей). «До» - PRAGMA, которые ставит сам ChatterBot, без наших
+    индексов; «после» - SQLITE_PRAGMAS и SQLITE_INDEXES. Запросы повторяют те,
+    что выполняют BestMatch, ChatterBot и сборка семантического индекса.
+    """
+    import shutil
+    import tempfile
+    
+    rng = random.Random(seed)
+    scan_queries = [
+        ('semantic_documents', "SELECT DISTINCT in_response_to, text FROM statement "
+         "WHERE in_response_to IS NOT NULL AND persona NOT LIKE 'bot:%' ORDER BY in_response_to, text"),
+    ]
+    
+    workdir = tempfile.mkdtemp(prefix='futurechat-sqlite-')
+    try:
+        base_path = os.path.join(workdir, 'base.sqlite3')
+        source = sqlite3.connect(CHATBOT_DATABASE_PATH)
+        base = sqlite3.connect(base_path)
+        source.backup(base)
+        source.close()
+        for name, _ in SQLITE_INDEXES:
+            base.execute(f"DROP INDEX IF EXISTS {name}")
+        
+        # Синтетические диалоги: пары вопрос-ответ в 500 разговорах
+        existing = base.execute("SELECT count(*) FROM statement").fetchone()[0]
+        vocabulary = [word.lower() for word in re.findall(r'\w+', " ".join(bot.get_russian_conversations()))]
+        vocabulary += [f"слово{i}" for i in range(20000)]
+        synthetic = []
+        for number in range(max(0, rows - existing) // 2):
+            question = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 8)))
+            answer = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 8)))
+            conversation = f"bench-{number % 500}"
+            synthetic.append((question, question, conversation, None, '', ''))
+            synthetic.append((answer, answer, conversation, question, question, 'bot:FutureChat Advanced'))
+        base.executemany(
+            "INSERT INTO statement (text, search_text, conversation, in_response_to, search_in_response_to, persona) "
+            "VALUES (?, ?, ?, ?, ?, ?)", synthetic
+        )
+        base.commit()
+        base.execute("PRAGMA journal_mode=DELETE")
+        sample = base.execute(
+            "SELECT text, search_text, conversation, in_response_to, search_in_response_to FROM statement"
+        ).fetchall()
+        base.close()
+        probes = [rng.choice(sample) for _ in range(queries)]
+        
+        def percentiles(latencies):
+            latencies.sort()
+            return {
+                'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+                'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 3)
+            }
+        
+        results = {'rows': len(sample), 'queries': queries}
+        for label in ('before', 'after'):
+            path = os.path.join(workdir, f'{label}.sqlite3')
+            shutil.copyfile(base_path, path)
+            connection = sqlite3.connect(path)
+            row = results[label] = {}
+            
+            if label == 'after':
+                tuning = SQLiteStorageTuning(None)
+                tuning.apply_pragmas(connection)
+                start = time.perf_counter()
+                tuning.create_indexes(connection)
+                row['index_build_s'] = round(time.perf_counter() - start, 3)
+                # Построение индексов целиком лежит в WAL - в работе его уберет первый же чекпоинт
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            else:
+                # То, что ChatterBot ставит сам при подключении
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            
+            row.update(time_statement_queries(connection, probes))
+            
+            for name, sql in scan_queries:
+                latencies = []
+                for _ in range(5):
+                    start = time.perf_counter()
+                    connection.execute(sql).fetchall()
+                    latencies.append(time.perf_counter() - start)
+                row[name] = percentiles(latencies)
+            
+            # Запись обучения пакетами, как LearningWriter: индексы удорожают вставку,
+            # а автоматические чекпоинты делают задержки пакетов неровными - смотрим среднее
+            latencies = []
+            for batch in range(50):
+                pairs = [probes[(batch * 100 + i) % len(probes)] for i in range(100)]
+                start = time.perf_counter()
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO statement (text, search_text, conversation, in_response_to, search_in_response_to, persona) "
+                        "VALUES (?, ?, ?, ?, ?, '')",
+                        [(text, search_text, 'bench-learning', in_response_to, search_in_response_to)
+                         for text, search_text, _, in_response_to, search_in_response_to in pairs]
+                    )
+                latencies.append(time.perf_counter() - start)
+            row['learning_batch'] = percentiles(latencies)
+            
+            row['wal_bytes'] = os.path.getsize(f'{path}-wal')
+            if label == 'after':
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                row['wal_bytes_after_checkpoint'] = os.path.getsize(f'{path}-wal')
+            connection.close()
+        
+        print(f"📊 SQLite: {results['rows']} записей, {queries} запросов на замер")
+        measures = [(name, 'p50_ms') for name, _, _ in SQLITE_PROBE_QUERIES] + [(name, 'p50_ms') for name, _ in scan_queries]
+        for name, measure in measures + [('learning_batch', 'mean_ms')]:
+            before, after = results['before'][name][measure], results['after'][name][measure]
+            speedup = f"x{before / after:.1f}" if after else "-"
+            print(f"   {name:<22} {measure[:-3]:<4} {before:>9.3f} мс -> {after:>9.3f} мс ({speedup})")
+        print(f"   индексы построены за {results['after']['index_build_s']} с; "
+              f"WAL {results['after']['wal_bytes']} байт -> {results['after']['wal_bytes_after_checkpoint']} после TRUNCATE")
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def benchmark_parsing(repeat=2000):
+    """Замер CPU анализаторов одного запроса: строка против ParsedInput"""
+    messages = [
+        "Привет! Как дела?",
+        "Что такое машинное обучение и как это работает?",
+        "Посоветуй, как улучшить память и не забывать важные дела",
+        "Расскажи историю про космос, пожалуйста!",
+        "Почему небо голубое? Объясни подробнее, мне интересно.",
+        "Сколько будет 15 + 27 * 3?",
+    ]
+    
+    def analyze(value):
+        bot.enhanced_intent_analysis(value)
+        bot.analyze_user_intent(value)
+        bot.extract_explanation_topic(value)
+        bot.analyze_question_type(value)
+        bot.analyze_problem_type(value)
+        bot.extract_story_topic(value)
+        bot.is_related_to_topic(value, 'программирование')
+        bot.get_fallback_response(value)
+        bot.get_semantic_response(value)
+    
+    results = {}
+    for label, prepare in (('string', lambda text: text), ('parsed', ParsedInput)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in messages:
+                # Каждый запрос - новый текст, кэш сканирования не помогает
+                bot.scan_keywords.cache_clear()
+                analyze(prepare(text))
+        results[f'{label}_us_per_request'] = round((time.perf_counter() - start) / (repeat * len(messages)) * 1e6, 2)
+    
+    results['saved_us_per_request'] = round(results['string_us_per_request'] - results['parsed_us_per_request'], 2)
+    print(f"📊 {results}")
+    return results
+
+def load_replay_corpus(path):
+    """Сообщения из JSONL-корпуса: поле message (или text/title/body) и необязательный session_id"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {'message': record}
+            message = next((record[field] for field in ('message', 'text', 'title', 'body')
+                            if isinstance(record.get(field), str)), None)
+            if message:
+                records.append({'message': message, 'session_id': record.get('session_id') or DEFAULT_SESSION})
+    return records
+
+def latency_summary(latencies):
+    """Число запросов и перцентили задержки в миллисекундах"""
+    latencies = sorted(latencies)
+    
+    def percentile(fraction):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 3)
+    
+    return {'count': len(latencies), 'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99)}
+
+def benchmark_replay(path, mode='inprocess', url='http://127.0.0.1:5000', concurrency=8, repeat=1, seed=42):
+    """Проигрывание корпуса запросов в процессе или по HTTP
+    
+    Отчет: пропускная способность, перцентили задержки по намерениям и
+    источникам и пиковый RSS отвечавшего процесса. В режиме http источник
+    сервер возвращает в ответе, а RSS берется из его /metrics (при
+    нескольких воркерах - того, кто ответил на /metrics); RSS самого
+    клиента - отдельно, client_peak_rss_kb.
+    """
+    import urllib.request
+    
+    records = load_replay_corpus(path) * repeat
+    if not records:
+        raise ValueError(f"в {path} нет сообщений")
+    random.seed(seed)
+    intents = [bot.enhanced_intent_analysis(ParsedInput(record['message']))[0] for record in records]
+    
+    def replay_inprocess(record):
+        start = time.perf_counter()
+        _, source, _ = bot.respond(record['message'], record['session_id'])
+        return time.perf_counter() - start, source
+    
+    def replay_http(record):
+        body = json.dumps({'message': record['message'], 'session_id': record['session_id']}).encode('utf-8')
+        request = urllib.request.Request(url.rstrip('/') + '/chat', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=60) as response:
+            payload = response.read()
+        latency = time.perf_counter() - start
+        return latency, json.loads(payload).get('source')
+    
+    started = time.perf_counter()
+    if mode == 'http':
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(replay_http, records))
+    else:
+        outcomes = [replay_inprocess(record) for record in records]
+    elapsed = time.perf_counter() - started
+    
+    by_intent = defaultdict(list)
+    by_source = defaultdict(list)
+    for intent, (latency, source) in zip(intents, outcomes):
+        by_intent[intent].append(latency)
+        by_source[source or 'нет ответа'].append(latency)
+    
+    results = {
+        'corpus': path,
+        'mode': mode,
+        'concurrency': concurrency if mode == 'http' else 1,
+        'seed': seed,
+        'requests': len(records),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(records) / elapsed, 2),
+        'latency': latency_summary([latency for latency, _ in outcomes]),
+        'by_intent': {intent: latency_summary(values) for intent, values in sorted(by_intent.items())},
+        'by_source': {source: latency_summary(values) for source, values in sorted(by_source.items())},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    if mode == 'http':
+        results['client_peak_rss_kb'] = results['peak_rss_kb']
+        server_rss = scrape_metric(url, 'futurechat_process_peak_rss_bytes')
+        results['peak_rss_kb'] = int(server_rss // 1024) if server_rss is not None else None
+    print(f"📊 {results['requests']} запросов за {results['elapsed_s']} с: {results['throughput_rps']} запр/с, "
+          f"p50 {results['latency']['p50_ms']} мс, p95 {results['latency']['p95_ms']} мс, p99 {results['latency']['p99_ms']} мс")
+    for group in ('by_intent', 'by_source'):
+        for name, summary in results[group].items():
+            print(f"   {name:>24}: {summary}")
+    if mode == 'http':
+        print(f"   пиковый RSS сервера: {results['peak_rss_kb']} КБ, клиента: {results['client_peak_rss_kb']} КБ")
+    else:
+        print(f"   пиковый RSS: {results['peak_rss_kb']} КБ")
+    return results
+
+def scrape_metric(url, name):
+    """Значение метрики без меток из /metrics сервера (None - сервер или метрика недоступны)"""
+    import urllib.request
+    
+    try:
+        with urllib.request.urlopen(url.rstrip('/') + '/metrics', timeout=10) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    for line in text.splitlines():
+        metric, _, value = line.partition(' ')
+        if metric == name:
+            return float(value)
+    return None
+
+def memory_usage(pid):
+    """Память процесса из /proc/<pid>/smaps_rollup в КБ: rss, pss, shared, private"""
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    usage[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        return None
+    return {
+        'rss': usage.get('Rss', 0),
+        'pss': usage.get('Pss', 0),
+        'shared': usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0),
+        'private': usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)
+    }
+
+class InFlightCounter:
+    """WSGI-обертка, считающая запросы в обработке (для плавной остановки воркера)"""
+    
+    def __init__(self, app):
+        self.app = app
+        self.active = 0
+        self.lock = threading.Lock()
+    
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.active += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self.release()
+            raise
+        # Тело не собираем: /chat/stream отдается по кадрам, и запрос
+        # заканчивается, только когда сервер закроет итератор
+        return InFlightBody(body, self.release)
+    
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+class InFlightBody:
+    """Тело ответа WSGI, отдаваемое по частям; close() отмечает конец запроса"""
+    
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.closed = False
+    
+    def __iter__(self):
+        return iter(self.body)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+class PreforkServer:
+    """Мастер-процесс с заранее порожденными воркерами
+
+    Бот и все индексы строятся один раз в мастере, после gc.freeze() воркеры
+    порождаются через fork и делят эти структуры по copy-on-write. Сигналы
+    мастеру: SIGHUP - плавная перезагрузка (мастер заново строит бота,
+    запускает новое поколение воркеров и только потом гасит старое),
+    SIGUSR1 - отчет о памяти воркеров, SIGTERM/SIGINT - остановка.
+    """
+    
+    def __init__(self, workers=SERVER_WORKERS, host='0.0.0.0', port=5000,
+                 graceful_timeout=SERVER_GRACEFUL_TIMEOUT, report_interval=SERVER_MEMORY_REPORT_INTERVAL):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.graceful_timeout = graceful_timeout
+        self.report_interval = report_interval
+        self.listener = None
+        self.children = {}
+        self.generation = 0
+        self.reload_requested = False
+        self.report_requested = False
+        self.stopping = False
+    
+    def bind(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+        self.listener = listener
+    
+    def prepare_fork(self):
+        """Фоновые потоки мастера останавливаются, живые объекты замораживаются для CoW"""
+        # Потоки через fork не переживают - воркеры получают уже прогретого бота
+        bot.wait_ready()
+        bot.stop_background_tasks()
+        gc.collect()
+        gc.freeze()
+    
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker()
+            finally:
+                os._exit(0)
+        self.children[pid] = self.generation
+        return pid
+    
+    def run_worker(self):
+        """Цикл воркера: свой WSGI-сервер на общем слушающем сокете"""
+        from werkzeug.serving import make_server
+        
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        bot.start_background_tasks(compact_journal=False)
+        
+        wsgi_app = InFlightCounter(app)
+        server = make_server(self.host, self.port, wsgi_app, threaded=True, fd=self.listener.fileno())
+        # shutdown() ждет выхода из serve_forever, поэтому зовем его из другого потока
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        server.serve_forever()
+        
+        deadline = time.monotonic() + self.graceful_timeout
+        while wsgi_app.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+        bot.stop_background_tasks()
+    
+    def reap(self):
+        """Сбор завершившихся воркеров и замена упавших"""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            if generation == self.generation and not self.stopping:
+                print(f"⚠️ Воркер {pid} завершился (код {os.waitstatus_to_exitcode(status)}), запускаю замену")
+                self.spawn()
+    
+    def reload(self):
+        """Плавная перезагрузка: новый бот, новое поколение, затем остановка старого"""
+        global bot
+        print("🔄 Перезагрузка: строю бота заново...")
+        gc.unfreeze()
+        try:
+            bot = WebAdvancedFutureChat()
+        except Exception as e:
+            print(f"❌ Перезагрузка не удалась, работают старые воркеры: {e}")
+            gc.freeze()
+            return
+        self.prepare_fork()
+        
+        old = [pid for pid, generation in self.children.items() if generation == self.generation]
+        self.generation += 1
+        for _ in range(self.workers):
+            self.spawn()
+        for pid in old:
+            self.signal(pid, signal.SIGTERM)
+        print(f"✅ Поколение {self.generation}: {self.workers} воркеров, старые завершаются")
+    
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+    
+    def report_memory(self):
+        """Память мастера и каждого воркера; PSS учитывает общие CoW-страницы"""
+        rows = [('master', os.getpid())] + [(f'worker/{generation}', pid) for pid, generation in sorted(self.children.items())]
+        print("📊 Память процессов (КБ):")
+        print(f"   {'процесс':>22} {'pid':>8} {'rss':>9} {'pss':>9} {'shared':>9} {'private':>9}")
+        for name, pid in rows:
+            usage = memory_usage(pid)
+            if usage:
+                print(f"   {name:>22} {pid:>8} {usage['rss']:>9} {usage['pss']:>9} {usage['shared']:>9} {usage['private']:>9}")
+    
+    def stop(self):
+        self.stopping = True
+        for pid in list(self.children):
+            self.signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            self.signal(pid, signal.SIGKILL)
+        self.reap()
+    
+    def run(self):
+        self.bind()
+        self.prepare_fork()
+        for _ in range(self.workers):
+            self.spawn()
+        print(f"🌐 Мастер {os.getpid()}: {self.workers} воркеров на http://{self.host}:{self.port}")
+        
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: setattr(self, 'report_requested', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopping', True))
+        
+        next_report = time.monotonic() + self.report_interval
+        while not self.stopping:
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            if self.report_requested or (self.report_interval and time.monotonic() >= next_report):
+                self.report_requested = False
+                next_report = time.monotonic() + self.report_interval
+                self.report_memory()
+            time.sleep(0.2)
+        
+        print("🛑 Остановка воркеров...")
+        self.stop()
+        self.listener.close()
+
+class AsyncChatServer:
+    """Асинхронный HTTP-сервер чата на asyncio
+
+    Соединения обслуживает цикл событий: открытое, но простаивающее
+    keep-alive соединение стоит одну корутину, а не поток, поэтому процесс
+    держит тысячи соединений. Стадии конвейера (разбор, ChatterBot, SQLite,
+    запись журнала знаний) выполняются в ограниченном пуле потоков и цикл
+    событий не блокируют; сверх ASYNC_MAX_PENDING ожидающих запросов сервер
+    отвечает 503. Тот же обработчик доступен как ASGI-приложение asgi_app.
+    """
+    
+    def __init__(self, host='0.0.0.0', port=5000, workers=ASYNC_WORKERS,
+                 max_pending=ASYNC_MAX_PENDING, keepalive_timeout=ASYNC_KEEPALIVE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-stage')
+        self.max_pending = max_pending
+        self.keepalive_timeout = keepalive_timeout
+        self.pending = 0
+        self.connections = 0
+    
+    async def handle(self, method, path, headers, body):
+        """Запрос -> (статус, заголовки, тело); общий для HTTP-сервера и ASGI"""
+        path = path.split('?', 1)[0]
+        if path == '/' and method in ('GET', 'HEAD'):
+            return 200, [('Content-Type', 'text/html; charset=utf-8')], HTML_TEMPLATE.encode('utf-8')
+        if path == '/healthz' and method in ('GET', 'HEAD'):
+            return self.json_response({'status': 'ok'})
+        if path == '/readyz' and method in ('GET', 'HEAD'):
+            state = bot.readiness()
+            return self.json_response(state, 200 if state['ready'] else 503)
+        if path == '/metrics' and method in ('GET', 'HEAD'):
+            return 200, [('Content-Type', 'text/plain; version=0.0.4')], bot.render_metrics().encode('utf-8')
+        if path not in ('/chat', '/chat/stream', '/chat/batch'):
+            return 404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not Found'
+        if method != 'POST':
+            return 405, [('Allow', 'POST'), ('Content-Type', 'text/plain; charset=utf-8')], b'Method Not Allowed'
+        
+        try:
+            data = json.loads(body or b'null')
+        except ValueError:
+            data = None
+        if path == '/chat/batch':
+            # Пачка занимает одно место в очереди, как и запрос /chat
+            if self.pending >= self.max_pending:
+                return self.overloaded()
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                payload, status = await loop.run_in_executor(self.executor, batch_answers, data)
+            finally:
+                self.pending -= 1
+            return self.json_response(payload, status)
+        if not isinstance(data, dict) or not data:
+            return self.json_response({'response': 'Неверные данные! 😕'}, 400 if path == '/chat/stream' else 200)
+        
+        cookie_session = None
+        if headers.get('cookie'):
+            morsel = SimpleCookie(headers['cookie']).get(SESSION_COOKIE)
+            cookie_session = morsel.value if morsel else None
+        session_id = data.get('session_id') or cookie_session
+        if not (isinstance(session_id, str) and 0 < len(session_id) <= 64):
+            session_id = secrets.token_urlsafe(16)
+        
+        extra = []
+        if cookie_session != session_id:
+            extra.append(('Set-Cookie', f"{SESSION_COOKIE}={session_id}; Max-Age={int(SESSION_IDLE_TIMEOUT)}; "
+                                        "HttpOnly; SameSite=Lax; Path=/"))
+        
+        if self.pending >= self.max_pending:
+            return self.overloaded()
+        self.pending += 1
+        if path == '/chat/stream':
+            headers = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')] + extra
+            return 200, headers, self.stream_events(data.get('message', ''), session_id)
+        try:
+            loop = asyncio.get_running_loop()
+            response, source = await loop.run_in_executor(self.executor, answer_message, data.get('message', ''), session_id)
+        except Exception as e:
+            print(f"Ошибка в чате: {e}")
+            response, source = 'Произошла ошибка в нейросети! Попробуй еще раз. 🤖', None
+        finally:
+            self.pending -= 1
+        return self.json_response({'response': response, 'source': source}, extra_headers=extra)
+    
+    async def stream_events(self, message, session_id):
+        """Тело /chat/stream по кадрам: start уходит до запуска конвейера
+        
+        Место в очереди занято handle и освобождается здесь, поэтому тело
+        обязательно итерируется и закрывается (aclose) отправителем.
+        """
+        try:
+            yield sse_event({'session_id': session_id}, 'start').encode('utf-8')
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self.executor, streamed_answer, message, session_id)
+        finally:
+            self.pending -= 1
+        for frame in answer_events(response):
+            yield frame.encode('utf-8')
+    
+    def overloaded(self):
+        return self.json_response({'response': 'Сервер перегружен, попробуй чуть позже! ⏳'}, 503)
+    
+    def json_response(self, payload, status=200, extra_headers=()):
+        headers = [('Content-Type', 'application/json')] + list(extra_headers)
+        return status, headers, json.dumps(payload).encode('utf-8')
+    
+    async def serve_connection(self, reader, writer):
+        """HTTP/1.1 с keep-alive; тело запроса только с Content-Length"""
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, path, version = lines[0].split(' ', 2)
+                except ValueError:
+                    await self.write_response(writer, 400, [], b'Bad Request', False)
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                if 'chunked' in headers.get('transfer-encoding', '').lower():
+                    await self.write_response(writer, 411, [], b'Length Required', False)
+                    return
+                try:
+                    length = int(headers.get('content-length', '0'))
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= ASYNC_MAX_BODY:
+                    await self.write_response(writer, 413, [], b'Payload Too Large', False)
+                    return
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                
+                status, response_headers, payload = await self.handle(method, path, headers, body)
+                if method == 'HEAD':
+                    response_headers = response_headers + [('Content-Length', str(len(payload)))]
+                    payload = b''
+                await self.write_response(writer, status, response_headers, payload, keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            self.connections -= 1
+            writer.close()
+    
+    async def write_response(self, writer, status, headers, payload, keep_alive):
+        """Ответ целиком (bytes) или по частям (асинхронный итератор, chunked)"""
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        streamed = not isinstance(payload, bytes)
+        if streamed:
+            lines.append('Transfer-Encoding: chunked')
+        elif not any(name == 'Content-Length' for name, _ in headers):
+            lines.append(f"Content-Length: {len(payload)}")
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        
+        if not streamed:
+            writer.write(head + payload)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            return
+        
+        # Заголовки уходят вместе с первым кадром: тело начинает итерироваться сразу
+        try:
+            async for chunk in payload:
+                writer.write(head + b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                head = b''
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            await payload.aclose()
+    
+    async def serve(self):
+        server = await asyncio.start_server(self.serve_connection, self.host, self.port,
+                                            backlog=4096, limit=64 * 1024)
+        print(f"⚡ Асинхронный сервер: http://{self.host}:{self.port}, "
+              f"пул {self.executor._max_workers} потоков, очередь до {self.max_pending}")
+        async with server:
+            await server.serve_forever()
+    
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=True)
+
+async def asgi_app(scope, receive, send):
+    """ASGI-приложение для внешних серверов: uvicorn main:asgi_app"""
+    global asgi_server
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    if asgi_server is None:
+        asgi_server = AsyncChatServer()
+    
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > ASYNC_MAX_BODY:
+            await send({'type': 'http.response.start', 'status': 413, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'Payload Too Large'})
+            return
+        if not message.get('more_body'):
+            break
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    status, response_headers, payload = await asgi_server.handle(scope['method'], scope['path'], headers, body)
+    start = {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers]
+    }
+    if isinstance(payload, bytes):
+        await send(start)
+        await send({'type': 'http.response.body', 'body': payload})
+        return
+    try:
+        async for chunk in payload:
+            if start:
+                await send(start)
+                start = None
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await payload.aclose()
+
+asgi_server = None
+
+def run_server(workers=SERVER_WORKERS, host='0.0.0.0', port=5000, use_async=False):
+    """Запуск веб-интерфейса (workers > 1 - многопроцессный сервер, use_async - asyncio)"""
     print("🚀 FutureChat Advanced - Единственная и самая мощная версия!")
     print("🧠 Инициализация нейросети и машинного обучения...")
-    print(f"🤖 ChatterBot статус: {'✅ Активен' if bot.chatbot_available else '❌ Ошибка'}")
-    print("🌐 Веб-интерфейс доступен на http://0.0.0.0:5000")
+    if bot.ready.is_set():
+        print(f"🤖 ChatterBot статус: {'✅ Активен' if bot.chatbot_available else '❌ Ошибка'}")
+    else:
+        print("🤖 ChatterBot статус: 🔥 Прогревается (готовность - /readyz)")
+    print(f"🌐 Веб-интерфейс доступен на http://{host}:{port}")
     print("🔥 Возможности: машинное обучение, математика, энциклопедия, контекстное мышление")
     print("🔄 Для остановки нажми Ctrl+C")
     print()
+    if use_async:
+        AsyncChatServer(host, port).run()
+    elif workers > 1:
+        PreforkServer(workers, host, port).run()
+    else:
+        app.run(host=host, port=port, debug=False)
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='FutureChat Advanced')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    serve_parser = subparsers.add_parser('serve', help='запуск веб-интерфейса (по умолчанию)')
+    serve_parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                              help='число процессов-воркеров (больше 1 - pre-fork сервер)')
+    serve_parser.add_argument('--host', default='0.0.0.0', help='адрес для прослушивания')
+    serve_parser.add_argument('--port', type=int, default=5000, help='порт')
+    serve_parser.add_argument('--async', dest='use_async', action='store_true',
+                              help='асинхронный сервер на asyncio вместо Flask')
+    
+    bench_search_parser = subparsers.add_parser('bench-search', help='замер поиска ChatterBot на таблицах разного размера')
+    bench_search_parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                                     help='размеры таблицы через запятую')
+    bench_search_parser.add_argument('--queries', type=int, default=200, help='число запросов на каждый размер')
+    bench_search_parser.add_argument('--baseline-limit', type=int, default=100000,
+                                     help='максимальный размер для замера полного перебора')
+    bench_search_parser.add_argument('--output', help='файл для результатов в JSON')
+    
+    bench_sqlite_parser = subparsers.add_parser('bench-sqlite', help='запросы ChatterBot к SQLite до и после настройки')
+    bench_sqlite_parser.add_argument('--rows', type=int, default=100000, help='размер таблицы statement в копии базы')
+    bench_sqlite_parser.add_argument('--queries', type=int, default=200, help='число запросов на каждый замер')
+    bench_sqlite_parser.add_argument('--output', help='файл для результатов в JSON')
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    maintain_parser = subparsers.add_parser('maintain', help='дедупликация, срок хранения и VACUUM базы ChatterBot')
+    maintain_parser.add_argument('--dry-run', action='store_true', help='только подсчитать, ничего не удалять')
+    maintain_parser.add_argument('--retention-days', type=float, default=RETENTION_DAYS,
+                                 help='срок хранения выученных записей в днях (0 - хранить всегда)')
+    maintain_parser.add_argument('--keep-occurrences', type=int, default=RETENTION_KEEP_OCCURRENCES,
+                                 help='устаревшие записи, встречавшиеся столько раз и чаще, сохраняются')
+    maintain_parser.add_argument('--output', help='файл для отчета в JSON')
+    
+    bench_parse_parser = subparsers.add_parser('bench-parse', help='замер анализаторов запроса со строкой и с ParsedInput')
+    bench_parse_parser.add_argument('--repeat', type=int, default=2000, help='число повторов набора сообщений')
+    
+    bench_parser = subparsers.add_parser('bench', help='проигрывание корпуса запросов JSONL с отчетом о задержках')
+    bench_parser.add_argument('corpus', nargs='?', default='requests.jsonl', help='файл JSONL с сообщениями')
+    bench_parser.add_argument('--mode', choices=('inprocess', 'http'), default='inprocess',
+                              help='в этом процессе или по HTTP к запущенному серверу')
+    bench_parser.add_argument('--url', default='http://127.0.0.1:5000', help='адрес сервера для режима http')
+    bench_parser.add_argument('--concurrency', type=int, default=8, help='число одновременных HTTP-запросов')
+    bench_parser.add_argument('--repeat', type=int, default=1, help='сколько раз проиграть корпус')
+    bench_parser.add_argument('--seed', type=int, default=42, help='зерно random для воспроизводимых ответов')
+    bench_parser.add_argument('--output', help='файл для результатов в JSON')
+    
+    subparsers.add_parser('startup-profile', help='разбивка времени запуска по импортам и фазам')
+    
+    snapshot_parser = subparsers.add_parser('build-snapshot', help='снимок производного состояния для быстрого запуска')
+    snapshot_parser.add_argument('--output', default=WARM_STATE_PATH or 'web_advanced_warm_state.bin',
+                                 help='файл снимка')
+    
+    args = parser.parse_args()
+    
+    # Служебным командам нужен полностью прогретый бот
+    if args.command not in (None, 'serve'):
+        bot.wait_ready()
+        if bot.warmup_thread:
+            # Поток прогрева еще печатает итоги (и профиль запуска) - дожидаемся его
+            bot.warmup_thread.join()
+    
+    if args.command == 'bench-search':
+        results = benchmark_search(
+            [int(size) for size in args.sizes.split(',')],
+            queries=args.queries,
+            baseline_limit=args.baseline_limit
+        )
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    elif args.command == 'bench-sqlite':
+        results = benchmark_sqlite(rows=args.rows, queries=args.queries)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    elif args.command == 'maintain':
+        if not bot.statement_maintenance:
+            sys.exit("❌ ChatterBot недоступен, обслуживать нечего")
+        bot.statement_maintenance.retention_days = args.retention_days
+        bot.statement_maintenance.keep_occurrences = args.keep_occurrences
+        report = bot.statement_maintenance.run_once(dry_run=args.dry_run, full_vacuum=True)
+        print_maintenance_report(report)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    elif args.command == 'bench-parse':
+        benchmark_parsing(repeat=args.repeat)
+    elif args.command == 'startup-profile':
+        if not STARTUP_PROFILE:
+            print_startup_profile()
+    elif args.command == 'build-snapshot':
+        header = bot.save_warm_state(args.output)
+        size = os.path.getsize(args.output)
+        print(f"🧊 Снимок состояния записан: {args.output} ({size / 1024:.0f} КБ, {len(header['arrays'])} массивов)")
+    elif args.command == 'bench':
+        results = benchmark_replay(args.corpus, mode=args.mode, url=args.url, concurrency=args.concurrency,
+                                   repeat=args.repeat, seed=args.seed)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    elif args.command == 'serve':
+        run_server(args.workers, args.host, args.port, args.use_async)
+    else:
+        run_server()